@@ -1,35 +1,48 @@
 from __future__ import annotations
 
 import argparse
+import atexit
 import base64
 import hashlib
 import hmac
 import os
 import shlex
 import sys
+import time
 from getpass import getpass
-from typing import Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 import readline
 import httpx
+import orjson
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
 
 
+USER_CACHE_TTL = 30.0
+USER_LIST_PAGE_SIZE = 200
+ERROR_DETAIL_LIMIT = 256
+HISTORY_FILE = os.path.expanduser("~/.fromchat_admin_history")
+HISTORY_LENGTH = 1000
+
+
 class CLIError(Exception):
     """Generic CLI error with a human-readable message."""
 
 
 def _hkdf_extract(salt: bytes, ikm: bytes) -> bytes:
-    return hmac.new(salt, ikm, hashlib.sha256).digest()
+    return hmac.digest(salt, ikm, "sha256")
 
 
 def _hkdf_expand(prk: bytes, info: bytes, length: int) -> bytes:
+    # A single SHA-256 block covers the common 32-byte case
+    if length <= hashlib.sha256().digest_size:
+        return hmac.digest(prk, info + b"\x01", "sha256")[:length]
     blocks: list[bytes] = []
     previous = b""
     counter = 1
     while len(b"".join(blocks)) < length:
-        previous = hmac.new(prk, previous + info + bytes([counter]), hashlib.sha256).digest()
+        previous = hmac.digest(prk, previous + info + bytes([counter]), "sha256")
         blocks.append(previous)
         counter += 1
     return b"".join(blocks)[:length]
@@ -42,16 +55,34 @@ def derive_auth_secret(username: str, password: str) -> str:
     return base64.b64encode(okm).decode("utf-8")
 
 
-def _read_single_key() -> str:
-    try:  # Windows
-        import msvcrt  # type: ignore
+def _normalize_words(words: Iterable[str]) -> List[str]:
+    """Mirror the server's blocklist normalization, keeping first-seen order."""
+    return list(dict.fromkeys(" ".join(w.split()).lower() for w in words if w.strip()))
+
+
+def _save_history() -> None:
+    try:
+        readline.write_history_file(HISTORY_FILE)
+    except OSError:
+        pass
+
 
+def _json(response: httpx.Response) -> Any:
+    return orjson.loads(response.content)
+
+
+try:  # Windows
+    import msvcrt  # type: ignore
+
+    def _read_single_key() -> str:
         ch = msvcrt.getch()
         return ch.decode("utf-8", errors="ignore").lower()
-    except ImportError:
-        import termios
-        import tty
 
+except ImportError:
+    import termios
+    import tty
+
+    def _read_single_key() -> str:
         fd = sys.stdin.fileno()
         old_settings = termios.tcgetattr(fd)
         try:
@@ -64,11 +95,48 @@ def _read_single_key() -> str:
 
 class AdminCLI:
     def __init__(self, api_url: str) -> None:
-        self.console = Console()
+        # Values are user-supplied text, so skip Rich's regex-based highlighting
+        self.console = Console(highlight=False)
+        readline.set_history_length(HISTORY_LENGTH)
+        try:
+            readline.read_history_file(HISTORY_FILE)
+        except OSError:
+            pass
+        atexit.register(_save_history)
         self.api_url = api_url.rstrip("/")
-        self.client = httpx.Client(base_url=self.api_url, timeout=30.0)
+        # HTTP/2 is negotiated via ALPN, so it only kicks in over TLS; plain http stays on HTTP/1.1
+        self.client = httpx.Client(
+            base_url=self.api_url,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=8, keepalive_expiry=60.0),
+            headers={"User-Agent": "FromChat-Admin/1"},
+        )
         self.username: Optional[str] = None
         self.token: Optional[str] = None
+        self._user_cache: Dict[str, Tuple[float, dict]] = {}
+        self._commands: Dict[str, Callable[[List[str]], None]] = {
+            "login": self.cmd_login,
+            "suspend": self.cmd_suspend,
+            "ban": self.cmd_suspend,
+            "unsuspend": self.cmd_unsuspend,
+            "unban": self.cmd_unsuspend,
+            "block-word": self.cmd_block_word,
+            "unblock-word": self.cmd_unblock_word,
+            "unblock-ip": self.cmd_unblock_ip,
+            "verify": self.cmd_verify,
+            "unverify": self.cmd_unverify,
+            "delete": self.cmd_delete,
+            "remove": self.cmd_delete,
+            "user": self.cmd_user,
+        }
+        self._simple_commands: Dict[str, Callable[[], None]] = {
+            "blocklist": self.cmd_list_blocklist,
+            "clear-all-rate-limits": self.cmd_clear_all_rate_limits,
+            "list": self.cmd_list_users,
+            "help": self.cmd_help,
+            "whoami": self.cmd_whoami,
+        }
 
     # --------------------------- HTTP helpers --------------------------- #
     def _auth_headers(self) -> dict:
@@ -85,12 +153,17 @@ class AdminCLI:
         response = self.client.request(method, rel_path, headers=headers, **kwargs)
         if response.status_code >= 400:
             detail = ""
-            try:
-                payload = response.json()
-                if isinstance(payload, dict):
-                    detail = payload.get("detail") or payload.get("message") or ""
-            except Exception:
-                detail = response.text
+            payload = None
+            # Only parse bodies that claim to be JSON; proxies tend to answer with HTML error pages
+            if response.headers.get("content-type", "").startswith("application/json"):
+                try:
+                    payload = _json(response)
+                except orjson.JSONDecodeError:
+                    pass
+            if payload is None:
+                detail = response.content[:ERROR_DETAIL_LIMIT].decode("utf-8", errors="replace")
+            elif isinstance(payload, dict):
+                detail = payload.get("detail") or payload.get("message") or ""
             message = f"{response.status_code} {response.reason_phrase}"
             if detail:
                 message = f"{message}: {detail}"
@@ -104,11 +177,24 @@ class AdminCLI:
 
     def _resolve_user(self, identifier: str) -> dict:
         self._require_auth()
-        if identifier.isdigit():
-            response = self._request("GET", f"user/id/{identifier}")
+        # Usernames are case-sensitive on the server, so they are cached exactly as given
+        if identifier.isascii() and identifier.isdigit():
+            key = path = f"user/id/{identifier}"
         else:
-            response = self._request("GET", f"user/{identifier.replace('@', '')}")
-        return response.json()
+            key = path = f"user/{identifier.replace('@', '')}"
+        cached = self._user_cache.get(key)
+        if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+            return cached[1]
+        user = _json(self._request("GET", path))
+        self._user_cache[key] = (time.monotonic(), user)
+        return user
+
+    def _invalidate_user(self, user: dict) -> None:
+        """Drop every cached lookup (by id or username) that points at this user."""
+        user_id = user.get("id")
+        stale = [key for key, (_, cached) in self._user_cache.items() if cached.get("id") == user_id]
+        for key in stale:
+            del self._user_cache[key]
 
     def _confirm(self, prompt: str) -> bool:
         self.console.print(f"[bold yellow]{prompt}[/] [green](y)[/] / [red](n)[/]: ", end="")
@@ -141,7 +227,7 @@ class AdminCLI:
         derived_password = derive_auth_secret(username, password)
         payload = {"username": username, "password": derived_password}
         response = self._request("POST", "login", json=payload, auth=False)
-        body = response.json()
+        body = _json(response)
         token = body.get("token")
         if not token:
             raise CLIError("Authentication succeeded but token was not returned.")
@@ -162,6 +248,7 @@ class AdminCLI:
             return
         payload = {"reason": reason}
         self._request("POST", f"user/{user['id']}/suspend", json=payload)
+        self._invalidate_user(user)
         log_reason = reason or "no reason provided"
         self.console.print(f"[bold red]User {user['username']} suspended ({log_reason}).[/]")
 
@@ -176,15 +263,19 @@ class AdminCLI:
             self.console.print("[yellow]Unsuspension cancelled.[/]")
             return
         self._request("POST", f"user/{user['id']}/unsuspend")
+        self._invalidate_user(user)
         self.console.print(f"[bold green]User {user['username']} unsuspended.[/]")
 
     def cmd_block_word(self, args: List[str]) -> None:
         if not args:
             raise CLIError("Usage: block-word <word or phrase> [additional words...]")
         self._require_auth()
-        words = args
+        words = _normalize_words(args)
+        if not words:
+            self.console.print("[yellow]Nothing to add.[/]")
+            return
         response = self._request("POST", "moderation/blocklist", json={"words": words})
-        data = response.json()
+        data = _json(response)
         added = data.get("added", [])
         current = data.get("words", [])
         if added:
@@ -195,21 +286,29 @@ class AdminCLI:
 
     def cmd_list_users(self) -> None:
         self._require_auth()
-        payload = self._request("GET", "user/list").json()
-        users = payload.get("users", [])
-        table = Table(title="Users", show_lines=False)
+        table = Table(title="Users", show_lines=False, show_edge=False)
         table.add_column("ID")
         table.add_column("Username")
         table.add_column("Display name")
         table.add_column("Suspended")
-        for user in users:
-            table.add_row(
-                str(user.get("id")),
-                user.get("username", ""),
-                user.get("display_name", ""),
-                "🚫" if user.get("suspended") else "✅",
-            )
-        self.console.print(table)
+        params: dict = {"limit": USER_LIST_PAGE_SIZE}
+        while True:
+            payload = _json(self._request("GET", "user/list", params=params))
+            for user in payload.get("users", []):
+                table.add_row(
+                    str(user.get("id")),
+                    user.get("username", ""),
+                    user.get("display_name", ""),
+                    "🚫" if user.get("suspended") else "✅",
+                )
+            next_cursor = payload.get("next_cursor")
+            if not next_cursor:
+                break
+            params["cursor"] = next_cursor
+        with self.console.capture() as capture:
+            self.console.print(table)
+        sys.stdout.write(capture.get())
+        sys.stdout.flush()
 
     def cmd_user(self, args: List[str]) -> None:
         if not args:
@@ -227,14 +326,19 @@ class AdminCLI:
             self.console.print("[yellow]Deletion cancelled.[/]")
             return
         self._request("POST", f"user/{user['id']}/delete")
+        self._invalidate_user(user)
         self.console.print(f"[bold red]User {user['username']} deleted.[/]")
 
     def cmd_unblock_word(self, args: List[str]) -> None:
         if not args:
             raise CLIError("Usage: unblock-word <word or phrase> [additional words...]")
         self._require_auth()
-        response = self._request("DELETE", "moderation/blocklist", json={"words": args})
-        data = response.json()
+        words = _normalize_words(args)
+        if not words:
+            self.console.print("[yellow]Nothing to remove.[/]")
+            return
+        response = self._request("DELETE", "moderation/blocklist", json={"words": words})
+        data = _json(response)
         removed = data.get("removed", [])
         current = data.get("words", [])
         if removed:
@@ -251,6 +355,7 @@ class AdminCLI:
             self.console.print(f"[yellow]{user['username']} is already verified.[/]")
             return
         self._request("POST", f"user/{user['id']}/verify")
+        self._invalidate_user(user)
         self.console.print(f"[bold green]{user['username']} marked as verified.[/]")
 
     def cmd_unverify(self, args: List[str]) -> None:
@@ -261,12 +366,13 @@ class AdminCLI:
             self.console.print(f"[yellow]{user['username']} is already unverified.[/]")
             return
         self._request("POST", f"user/{user['id']}/verify")
+        self._invalidate_user(user)
         self.console.print(f"[bold green]{user['username']} is now unverified.[/]")
 
     def cmd_list_blocklist(self) -> None:
         self._require_auth()
         response = self._request("GET", "moderation/blocklist")
-        words = response.json().get("words", [])
+        words = _json(response).get("words", [])
         if not words:
             self.console.print("[cyan]Blocklist is empty.[/]")
             return
@@ -284,7 +390,7 @@ class AdminCLI:
         if not ip:
             raise CLIError("IP address cannot be empty")
         response = self._request("POST", "moderation/unblock-ip", json={"ip": ip})
-        data = response.json()
+        data = _json(response)
         message = data.get("message", "IP unblocked")
         self.console.print(f"[bold green]{message}[/]")
 
@@ -295,7 +401,7 @@ class AdminCLI:
             self.console.print("[yellow]Operation cancelled.[/]")
             return
         response = self._request("POST", "moderation/clear-all-rate-limits")
-        data = response.json()
+        data = _json(response)
         message = data.get("message", "Rate limits cleared")
         self.console.print(f"[bold green]{message}[/]")
 
@@ -360,42 +466,18 @@ class AdminCLI:
                 break
 
             try:
-                if command == "login":
-                    self.cmd_login(args)
-                elif command in {"suspend", "ban"}:
-                    self.cmd_suspend(args)
-                elif command in {"unsuspend", "unban"}:
-                    self.cmd_unsuspend(args)
-                elif command == "block-word":
-                    self.cmd_block_word(args)
-                elif command == "unblock-word":
-                    self.cmd_unblock_word(args)
-                elif command == "blocklist":
-                    self.cmd_list_blocklist()
-                elif command == "unblock-ip":
-                    self.cmd_unblock_ip(args)
-                elif command == "clear-all-rate-limits":
-                    self.cmd_clear_all_rate_limits()
-                elif command == "verify":
-                    self.cmd_verify(args)
-                elif command == "unverify":
-                    self.cmd_unverify(args)
-                elif command in {"delete", "remove"}:
-                    self.cmd_delete(args)
-                elif command == "list":
-                    self.cmd_list_users()
-                elif command == "user":
-                    self.cmd_user(args)
-                elif command == "help":
-                    self.cmd_help()
-                elif command == "whoami":
-                    self.cmd_whoami()
+                if command in self._commands:
+                    self._commands[command](args)
+                elif command in self._simple_commands:
+                    self._simple_commands[command]()
                 else:
                     self.console.print("[yellow]Unknown command. Type /help for a list of commands.[/]")
             except CLIError as err:
                 self.console.print(f"[red]Error:[/] {err}")
             except httpx.RequestError as err:
                 self.console.print(f"[red]Network error:[/] {err}")
+            except KeyboardInterrupt:
+                self.console.print("\n[yellow]Cancelled.[/]")
 
         self.client.close()
 
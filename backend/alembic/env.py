@@ -2,6 +2,7 @@ from logging.config import fileConfig
 import logging
 
 from sqlalchemy import engine_from_config
+from sqlalchemy import event
 from sqlalchemy import pool
 
 from alembic import context
@@ -11,15 +12,27 @@ from alembic import context
 config = context.config
 
 # Interpret the config file for Python logging.
-# This line sets up loggers basically.
-if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
+# This line sets up loggers basically. Skipped when migrations run inside
+# the app process, where uvicorn already owns the logging setup.
+if config.config_file_name is not None and config.get_main_option("configure_logging", "true") != "false":
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
 from models import Base
 target_metadata = Base.metadata
 
+# Per-connection tuning for the upgrade's DDL, so it doesn't fsync after every
+# statement. Mirrors SQLITE_PRAGMAS in db.py, which can't be imported here
+# without pulling in the app settings.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -63,6 +76,16 @@ def run_migrations_online() -> None:
         poolclass=pool.NullPool,
     )
 
+    if connectable.dialect.name == "sqlite":
+        @event.listens_for(connectable, "connect")
+        def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for pragma in SQLITE_PRAGMAS:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
     with connectable.connect() as connection:
         context.configure(
             connection=connection, target_metadata=target_metadata
@@ -1,52 +1,58 @@
 import asyncio
-import time
-from fastapi import FastAPI, Request
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
-import subprocess
-import sys
-import os
+from sqlalchemy import select, update
 from routes import account, messaging, profile, push, webrtc, devices, moderation
+from routes.messaging import messagingManager
 import logging
 from models import User
 from constants import OWNER_USERNAME
-from utils import get_client_ip
 
 from db import POOL_CONFIG, SessionLocal
+from migration import run_migrations_exclusive
+from middleware import AccessLoggingMiddleware, FastCORSMiddleware
+from push_service import push_service
 from logging_config import access_logger  # noqa: F401 - ensure loggers configured
 from security.audit import log_access
-from security.rate_limit import limiter
+from security.rate_limit import limiter, reset_all_rate_limits, start_rate_limit_cleanup_task
 from slowapi.middleware import SlowAPIMiddleware
 
 logger = logging.getLogger("uvicorn.error")
 
+ALLOWED_ORIGINS = [
+    "https://fromchat.ru",
+    "https://beta.fromchat.ru",
+    "https://www.fromchat.ru",
+    "http://127.0.0.1:8301",
+    "http://127.0.0.1:8300",
+    "http://localhost:8301",
+    "http://localhost:8300",
+]
+ALLOWED_METHODS = ["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"]
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup - run migration in subprocess to avoid logging interference
+    # Startup - run migrations in a worker thread so the event loop stays free
     try:
         logger.info("Starting database migration check...")
-        # Run migration in a separate process
-        subprocess.run(
-            [
-                sys.executable, 
-                "-c", 
-                "import sys; sys.path.append('.'); from migration import run_migrations; run_migrations()"
-            ], 
-            cwd=os.path.dirname(os.path.abspath(__file__))
-        )
+        await asyncio.to_thread(run_migrations_exclusive)
     except Exception as e:
         logger.error(f"Failed to run database migrations: {e}")
         raise
 
     try:
         with SessionLocal() as db:
-            owner = db.query(User).filter(User.id == 1).first()
-            if owner and not owner.verified:
-                owner.verified = True
-                db.commit()
+            result = db.execute(
+                update(User)
+                .where(User.id == 1, User.verified.is_not(True))
+                .values(verified=True)
+            )
+            db.commit()
+            if result.rowcount:
                 logger.info(f"Owner user '{OWNER_USERNAME}' has been verified")
-            elif owner and owner.verified:
+            elif db.execute(select(1).where(User.id == 1)).first():
                 logger.info(f"Owner user '{OWNER_USERNAME}' is already verified")
             else:
                 logger.warning(f"Owner user '{OWNER_USERNAME}' not found")
@@ -62,9 +68,14 @@ async def lifespan(app: FastAPI):
         POOL_CONFIG["pool_pre_ping"],
     )
 
+    # Tokens registered before the public chat topic was enabled still need to join it
+    try:
+        await push_service.subscribe_stored_tokens_to_public_chat_topic()
+    except Exception as e:
+        logger.error(f"Failed to subscribe stored FCM tokens to the public chat topic: {e}")
+
     # Start the messaging cleanup task
     try:
-        from routes.messaging import messagingManager
         messagingManager.start_cleanup_task()
         logger.info("Messaging cleanup task started")
     except Exception as e:
@@ -73,7 +84,6 @@ async def lifespan(app: FastAPI):
     # Reset all rate limits on startup to ensure clean state
     # This prevents rate limits from persisting across restarts
     try:
-        from security.rate_limit import reset_all_rate_limits
         cleared = reset_all_rate_limits()
         if cleared > 0:
             logger.info(f"Cleared {cleared} rate limit entries on startup")
@@ -82,7 +92,6 @@ async def lifespan(app: FastAPI):
     
     # Start the rate limit cleanup task
     try:
-        from security.rate_limit import start_rate_limit_cleanup_task
         cleanup_task = asyncio.create_task(start_rate_limit_cleanup_task())
         logger.info("Rate limit cleanup task started")
     except Exception as e:
@@ -99,72 +108,33 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
 
+    # Send the push notifications still queued
+    await push_service.stop()
+
 # Инициализация FastAPI
-app = FastAPI(title="FromChat", lifespan=lifespan)
+app = FastAPI(title="FromChat", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Add rate limiting middleware
 app.state.limiter = limiter
 app.add_middleware(SlowAPIMiddleware)
 
-
-@app.middleware("http")
-async def access_logging_middleware(request: Request, call_next):
-    # Log incoming request and Authorization header presence for debugging auth issues
+def _write_access_log(entry: dict) -> None:
+    # log_access only renders the record; its QueueListener thread does the file I/O
     try:
-        auth_header = request.headers.get("authorization")
-        if auth_header:
-            short = auth_header[:20] + "..." if len(auth_header) > 20 else auth_header
-            logger.info("Incoming request %s %s Authorization=%s", request.method, request.url.path, short)
-        else:
-            logger.info("Incoming request %s %s Authorization=NONE", request.method, request.url.path)
-    except Exception:
-        pass
-    start = time.perf_counter()
-    try:
-        response = await call_next(request)
-    except Exception as exc:
-        duration = time.perf_counter() - start
-        user = getattr(getattr(request, "state", None), "current_user", None)
-        log_access(
-            "http_error",
-            method=request.method,
-            path=request.url.path,
-            status="error",
-            user=getattr(user, "username", None),
-            ip=get_client_ip(request),
-            duration=f"{duration:.3f}s",
-            error=str(exc),
-        )
-        raise
-    else:
-        duration = time.perf_counter() - start
-        user = getattr(getattr(request, "state", None), "current_user", None)
-        log_access(
-            "http_request",
-            method=request.method,
-            path=request.url.path,
-            status=response.status_code,
-            user=getattr(user, "username", None),
-            ip=get_client_ip(request),
-            duration=f"{duration:.3f}s",
-        )
-        return response
+        log_access(**entry)
+    except Exception as e:
+        logger.error(f"Failed to write access log entry: {e}")
+
+
+app.add_middleware(AccessLoggingMiddleware, sink=_write_access_log)
 
 
 # CORS
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "https://fromchat.ru",
-        "https://beta.fromchat.ru",
-        "https://www.fromchat.ru",
-        "http://127.0.0.1:8301",
-        "http://127.0.0.1:8300",
-        "http://localhost:8301",
-        "http://localhost:8300",
-    ],
+    FastCORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=ALLOWED_METHODS,
     allow_headers=["*"],
 )
 
@@ -1,6 +1,6 @@
 import os
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from constants import DATABASE_URL
 
 # Ensure data directory exists
@@ -37,4 +37,31 @@ engine = create_engine(
     **engine_kwargs,
 )
 
+SQLITE_PRAGMAS = (
+    # Readers no longer block on the writer
+    "PRAGMA journal_mode=WAL",
+    # WAL makes per-transaction fsyncs unnecessary for durability of the database file
+    "PRAGMA synchronous=NORMAL",
+    # Wait for the write lock instead of failing with "database is locked"
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    # Reads are served from the shared mmap; the page cache is per connection,
+    # so it stays at SQLite's default size
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Connect event listener that applies SQLITE_PRAGMAS to a new connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+if DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
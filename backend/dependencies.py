@@ -1,15 +1,59 @@
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
+from constants import TOKEN_INACTIVITY_EXPIRE_HOURS
 from utils import verify_token
 from models import User, DeviceSession
 from db import SessionLocal
+import hashlib
 import logging
+import time
 
 security = HTTPBearer()
 logger = logging.getLogger("uvicorn.error")
 
+# last_seen is only used for the (days-long) inactivity expiry, so it is
+# written at most once per session per debounce window
+LAST_SEEN_DEBOUNCE_SECONDS = 60
+LAST_SEEN_CACHE_MAX_SIZE = 10_000
+_last_seen_written: dict[str, float] = {}
+
+# Verified JWT payloads, keyed by a hash of the token. Only the signature
+# check is skipped on a hit; the session is still validated against the DB,
+# so revocation takes effect immediately.
+TOKEN_CACHE_TTL_SECONDS = 30
+TOKEN_CACHE_MAX_SIZE = 10_000
+_verified_tokens: dict[bytes, tuple[float, dict]] = {}
+
+
+def _prune_last_seen_written(now: float) -> None:
+    # Entries past the debounce window would be rewritten anyway, so dropping them changes nothing.
+    # Requests on other threadpool threads insert concurrently, so work on a snapshot.
+    stale = [session_id for session_id, written in list(_last_seen_written.items()) if now - written >= LAST_SEEN_DEBOUNCE_SECONDS]
+    for session_id in stale:
+        _last_seen_written.pop(session_id, None)
+    if len(_last_seen_written) >= LAST_SEEN_CACHE_MAX_SIZE:
+        _last_seen_written.clear()
+
+
+def _verify_token_cached(token: str) -> dict | None:
+    key = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+    now = time.time()
+    cached = _verified_tokens.get(key)
+    if cached is not None and now < cached[0]:
+        return cached[1]
+
+    payload = verify_token(token)
+    if payload:
+        if len(_verified_tokens) >= TOKEN_CACHE_MAX_SIZE:
+            _verified_tokens.clear()
+        # Never keep a payload past the token's own expiry
+        expires_at = min(now + TOKEN_CACHE_TTL_SECONDS, payload.get("exp", now))
+        _verified_tokens[key] = (expires_at, payload)
+    return payload
+
 # Зависимость для получения сессии БД
 def get_db():
     db = SessionLocal()
@@ -26,7 +70,7 @@ def get_current_user(
 ) -> User:
     token = credentials.credentials
     try:
-        payload = verify_token(token)
+        payload = _verify_token_cached(token)
     except Exception as e:
         logger.warning("get_current_user: token verification error: %s", str(e))
         raise HTTPException(
@@ -41,14 +85,34 @@ def get_current_user(
             detail="Invalid or expired token",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    user = db.query(User).filter(User.id == payload["user_id"]).first()
-    if not user:
+    # Validate device session from JWT
+    session_id = payload.get("session_id")
+    if not session_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid session",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    # Load the user and its device session in one query; the outer join keeps
+    # "user not found" distinguishable from "session not found"
+    row = (
+        db.query(User, DeviceSession)
+        .outerjoin(
+            DeviceSession,
+            and_(DeviceSession.user_id == User.id, DeviceSession.session_id == session_id),
+        )
+        .filter(User.id == payload["user_id"])
+        .first()
+    )
+    if not row:
         logger.info("get_current_user: user not found for user_id=%s", payload.get("user_id"))
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    user, device_session = row
 
     if user.id == 1 and user.suspended:
         user.suspended = False
@@ -56,21 +120,6 @@ def get_current_user(
         db.commit()
         db.refresh(user)
 
-    # Validate device session from JWT
-    session_id = payload.get("session_id")
-    if not session_id:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid session",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
-    device_session = (
-        db.query(DeviceSession)
-        .filter(DeviceSession.user_id == user.id, DeviceSession.session_id == session_id)
-        .first()
-    )
-
     if not device_session or device_session.revoked:
         logger.info("get_current_user: session missing/revoked for user_id=%s session_id=%s", user.id, session_id)
         raise HTTPException(
@@ -80,7 +129,6 @@ def get_current_user(
         )
 
     # Check if session has been inactive for too long (sliding expiration)
-    from constants import TOKEN_INACTIVITY_EXPIRE_HOURS
     inactivity_threshold = datetime.now() - timedelta(hours=TOKEN_INACTIVITY_EXPIRE_HOURS)
     if device_session.last_seen < inactivity_threshold:
         # Session expired due to inactivity - revoke it
@@ -94,8 +142,14 @@ def get_current_user(
         )
 
     # Touch last_seen on valid session (sliding expiration - extends token life)
-    device_session.last_seen = datetime.now()
-    db.commit()
+    now = time.monotonic()
+    last_written = _last_seen_written.get(session_id)
+    if last_written is None or now - last_written >= LAST_SEEN_DEBOUNCE_SECONDS:
+        device_session.last_seen = datetime.now()
+        db.commit()
+        if len(_last_seen_written) >= LAST_SEEN_CACHE_MAX_SIZE:
+            _prune_last_seen_written(now)
+        _last_seen_written[session_id] = now
 
     # Check if user is suspended
     if user.suspended:
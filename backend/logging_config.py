@@ -1,9 +1,12 @@
+import atexit
 import logging
 import os
+import queue
+import time
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from threading import RLock
+from threading import Lock
 from typing import Dict
 
 LOGS_DIR = Path(__file__).resolve().parent / "logs"
@@ -14,7 +17,7 @@ class HumanReadableFileHandler(RotatingFileHandler):
     def __init__(self, filename: Path, level: int) -> None:
         super().__init__(filename, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8", delay=True)
         self.level = level
-        self._lock = RLock()
+        self._lock = Lock()
         self._last_date: str | None = None
         self._previous_entry: str | None = None
 
@@ -55,12 +58,49 @@ class HumanReadableFileHandler(RotatingFileHandler):
                     return
                 self.stream.write(entry_text + "\n")
                 self._previous_entry = entry_text
-                self.flush()
         except Exception:
             self.handleError(record)
 
 
+# A batch is written out after this many records or once the window closes
+LOG_BATCH_MAX_RECORDS = 256
+LOG_BATCH_WINDOW_SECONDS = 0.05
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    Drains queued records in batches of up to LOG_BATCH_MAX_RECORDS collected
+    within LOG_BATCH_WINDOW_SECONDS. Handlers write into their buffered
+    stream and are flushed once per batch, so a burst of records costs a
+    single write() instead of one per record.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: logging.Handler) -> None:
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+
+    def _monitor(self) -> None:
+        while True:
+            record = self.queue.get()
+            deadline = time.monotonic() + LOG_BATCH_WINDOW_SECONDS
+            batch_size = 0
+            while record is not self._sentinel:
+                self.handle(record)
+                batch_size += 1
+                timeout = deadline - time.monotonic()
+                if batch_size >= LOG_BATCH_MAX_RECORDS or timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            for handler in self.handlers:
+                handler.flush()
+            if record is self._sentinel:
+                break
+
+
 _HANDLED_FILES: Dict[str, Path] = {}
+_LISTENERS: Dict[str, QueueListener] = {}
 
 
 def _configure_logger(name: str, filename: str, level: int = logging.INFO) -> logging.Logger:
@@ -71,10 +111,20 @@ def _configure_logger(name: str, filename: str, level: int = logging.INFO) -> lo
         return logger
 
     logger.handlers.clear()
-
-    handler = HumanReadableFileHandler(target_path, level)
-    handler.setLevel(level)
-    logger.addHandler(handler)
+    previous_listener = _LISTENERS.pop(name, None)
+    if previous_listener is not None:
+        previous_listener.stop()
+
+    # Callers only enqueue; a single listener thread per file does the I/O
+    file_handler = HumanReadableFileHandler(target_path, level)
+    file_handler.setLevel(level)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = BatchingQueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    _LISTENERS[name] = listener
+
+    logger.addHandler(QueueHandler(log_queue))
     logger.setLevel(level)
     logger.propagate = False
 
@@ -1,7 +1 @@
-from constants import *
-from db import *
-from models import *
-from validation import *
-from utils import *
-from dependencies import *
-from app import *
\ No newline at end of file
+from app import app  # noqa: F401 - entrypoint for uvicorn/fastapi run
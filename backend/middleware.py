@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import Callable
+
+from starlette.middleware.cors import CORSMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils import get_client_ip_from_scope
+
+logger = logging.getLogger("uvicorn.error")
+
+# Requests that never carry credentials worth debugging
+_NOISY_PATHS = frozenset(("/docs", "/redoc", "/openapi.json"))
+
+
+class FastCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware with a set-based origin check instead of a list scan."""
+
+    def __init__(self, app: ASGIApp, allow_origins=(), **kwargs) -> None:
+        super().__init__(app, allow_origins=allow_origins, **kwargs)
+        self._allow_origins_set = frozenset(allow_origins)
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.allow_all_origins or self.allow_origin_regex is not None:
+            return super().is_allowed_origin(origin)
+        return origin in self._allow_origins_set
+
+
+class AccessLoggingMiddleware:
+    """
+    Pure ASGI access logger. Unlike @app.middleware("http") it does not wrap
+    the response in BaseHTTPMiddleware's body-streaming task pair; it only
+    watches the `send` calls for the status code.
+    """
+
+    def __init__(self, app: ASGIApp, sink: Callable[[dict], None]) -> None:
+        self.app = app
+        self.sink = sink
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        path = scope["path"]
+        client_ip = get_client_ip_from_scope(scope)
+        # Log incoming request and Authorization header presence for debugging auth issues
+        if method != "OPTIONS" and path not in _NOISY_PATHS and logger.isEnabledFor(logging.INFO):
+            auth_header = "NONE"
+            for key, value in scope["headers"]:
+                if key == b"authorization":
+                    auth_header = value.decode("latin-1")
+                    break
+            if len(auth_header) > 20:
+                auth_header = auth_header[:20] + "..."
+            logger.info("Incoming request %s %s Authorization=%s", method, path, auth_header)
+
+        status_code = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.monotonic_ns()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exc:
+            duration_us = (time.monotonic_ns() - start) // 1000
+            user = scope.get("state", {}).get("current_user")
+            self.sink({
+                "action": "http_error",
+                "method": method,
+                "path": path,
+                "status": "error",
+                "user": user.username if user is not None else None,
+                "ip": client_ip,
+                "duration_us": duration_us,
+                "error": str(exc),
+            })
+            raise
+        duration_us = (time.monotonic_ns() - start) // 1000
+        user = scope.get("state", {}).get("current_user")
+        self.sink({
+            "action": "http_request",
+            "method": method,
+            "path": path,
+            "status": status_code,
+            "user": user.username if user is not None else None,
+            "ip": client_ip,
+            "duration_us": duration_us,
+        })
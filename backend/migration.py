@@ -2,16 +2,109 @@
 Database migration utility using Alembic.
 This module handles running database migrations on startup.
 """
+import functools
+import hashlib
 import os
 import logging
 from alembic import command
+from alembic.autogenerate import produce_migrations
 from alembic.config import Config
 from alembic.runtime.migration import MigrationContext
-from sqlalchemy import create_engine
+from alembic.script import ScriptDirectory
+from alembic.util import rev_id
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, create_engine, event, inspect, text
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex, CreateTable
 from constants import DATABASE_URL
-import logging
+from db import apply_sqlite_pragmas
+from models import Base
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger("uvicorn.error")
+
+MIGRATION_LOCK_PATH = os.path.join("data", ".migration.lock")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+ALEMBIC_INI_PATH = os.path.join(BACKEND_DIR, "alembic.ini")
+VERSIONS_DIR = os.path.join(BACKEND_DIR, "alembic", "versions")
+
+# Set to 0 where revisions are shipped with the code, so startup only
+# upgrades and never reflects the database to generate new ones
+AUTOGEN_MIGRATIONS = os.getenv("FROMCHAT_AUTOGEN_MIGRATIONS", "1") == "1"
+
+ALEMBIC_VERSION_DDL = """
+    CREATE TABLE IF NOT EXISTS alembic_version (
+        version_num VARCHAR(32) NOT NULL,
+        CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num)
+    )
+"""
+
+# Format version, fingerprint of the models and the revision they were last
+# migrated to, kept next to the database like the other runtime state in data/
+SCHEMA_FINGERPRINT_PATH = os.path.join("data", ".schema_fp")
+# Bumped whenever the fingerprint changes what it covers, so stored ones are recomputed
+SCHEMA_FINGERPRINT_FORMAT = "2"
+# Contents of SCHEMA_FINGERPRINT_PATH, kept in sync with writes; None until first read
+_persisted_fingerprint = None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_engine():
+    """
+    Engine shared by every migration phase. NullPool, because migrations run
+    once per process and the connections should not outlive them.
+    """
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+
+    if DATABASE_URL.startswith("sqlite"):
+        # Same tuning as the app's connections, so the schema changes and
+        # version writes don't fsync after every commit
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+
+    return engine
+
+
+@functools.lru_cache(maxsize=1)
+def _get_alembic_config():
+    """Alembic configuration for the app database, built once per process."""
+    alembic_cfg = Config(ALEMBIC_INI_PATH)
+
+    # Disable Alembic's logging configuration to avoid interfering with FastAPI
+    alembic_cfg.set_main_option("configure_logging", "false")
+
+    # Set the database URL in the config
+    alembic_cfg.set_main_option("sqlalchemy.url", DATABASE_URL)
+
+    return alembic_cfg
+
+
+def _head_revision(alembic_cfg):
+    """Head revision of the migration scripts, or None if there are none."""
+    # Read fresh each time, as run_migrations may have just written a revision
+    return ScriptDirectory.from_config(alembic_cfg).get_current_head()
+
+
+def run_migrations_exclusive():
+    """
+    Run migrations while holding an exclusive file lock, so that only one
+    uvicorn worker migrates at a time and the others wait for it to finish.
+    """
+    if fcntl is None:
+        run_migrations()
+        return
+
+    os.makedirs(os.path.dirname(MIGRATION_LOCK_PATH), exist_ok=True)
+    with open(MIGRATION_LOCK_PATH, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            run_migrations()
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
-logger = logging.getLogger(__name__)
 
 def run_migrations():
     """
@@ -20,116 +113,76 @@ def run_migrations():
     Fully automated - handles all scenarios automatically.
     """
     try:
-        # FIRST: Check if database has any application tables (excluding alembic_version)
-        engine = create_engine(DATABASE_URL)
+        alembic_cfg = _get_alembic_config()
+
+        # Nothing to do if the models haven't changed since the last
+        # successful migration and the database is still at head
+        fingerprint = _schema_fingerprint()
+        needs_migration, current_rev, _ = check_migration_status(alembic_cfg)
+        if not needs_migration and _fingerprint_matches(fingerprint, current_rev):
+            logger.info("Database schema is up to date, skipping migrations.")
+            return
+
+        # Check if database has alembic_version and any application tables, in one query
+        engine = _get_engine()
         with engine.connect() as connection:
-            from sqlalchemy import inspect
-            inspector = inspect(connection)
-            existing_tables = [table for table in inspector.get_table_names()
-                             if not table.startswith('sqlite_') and table != 'alembic_version']
+            has_alembic_version, app_table_count = _probe_table_state(connection)
 
         # If no application tables exist, create them directly from models
-        if not existing_tables:
+        if not app_table_count:
             logger.info("No application tables found. Creating all tables directly from models...")
-            from models import Base
             Base.metadata.create_all(bind=engine)
             logger.info("All tables created successfully from models.")
-
-        # Get the directory where this script is located
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-
-        # Create Alembic configuration
-        alembic_cfg = Config(os.path.join(current_dir, "alembic.ini"))
-
-        # Disable Alembic's logging configuration to avoid interfering with FastAPI
-        alembic_cfg.set_main_option("configure_logging", "false")
-
-        # Set the database URL in the config
-        alembic_cfg.set_main_option("sqlalchemy.url", DATABASE_URL)
+            app_table_count = len(_sorted_app_tables())
 
         # Check if any migration files exist
-        versions_dir = os.path.join(current_dir, "alembic", "versions")
-
-        if not os.path.exists(versions_dir):
-            os.makedirs(versions_dir)
+        os.makedirs(VERSIONS_DIR, exist_ok=True)
 
-        migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-        
-        if not migration_files:
+        if not _head_revision(alembic_cfg):
             logger.info("No migration files found. Creating initial migration...")
+            if not AUTOGEN_MIGRATIONS:
+                # Describe the models directly instead of diffing them with autogenerate
+                _create_complete_migration(alembic_cfg)
             # Check if database exists and has tables
-            engine = create_engine(DATABASE_URL)
-            with engine.connect() as connection:
-                from sqlalchemy import text
-                result = connection.execute(text("SELECT name FROM sqlite_master WHERE type='table' AND name != 'alembic_version'"))
-                existing_tables = result.fetchall()
-                
-                if existing_tables:
-                    logger.info("Found existing database with tables. Creating migration to match current schema...")
-                    # Create migration with autogenerate to detect differences
-                    command.revision(alembic_cfg, autogenerate=True, message="Initial migration from existing database")
-                    
-                    # Check if the generated migration is empty (common with existing databases)
-                    versions_dir = os.path.join(current_dir, "alembic", "versions")
-                    migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-                    if migration_files:
-                        latest_migration = max(migration_files)
-                        migration_path = os.path.join(versions_dir, latest_migration)
-                        
-                        # Check if migration is empty
-                        with open(migration_path, 'r') as f:
-                            content = f.read()
-                            if 'pass' in content and 'op.create_table' not in content and 'op.add_column' not in content:
-                                logger.info("Generated migration is empty. Creating complete schema migration...")
-                                # Remove the empty migration
-                                os.remove(migration_path)
-                                # Create a complete migration
-                                _create_complete_migration(alembic_cfg)
+            elif app_table_count:
+                logger.info("Found existing database with tables. Creating migration to match current schema...")
+                # An autogenerated migration would be empty when the database already
+                # matches the models (common with existing databases)
+                if _autogenerate_is_empty():
+                    logger.info("Database already matches the models. Creating complete schema migration...")
+                    _create_complete_migration(alembic_cfg)
                 else:
-                    logger.info("No existing tables found. Creating fresh migration...")
-                    # Create fresh migration
-                    command.revision(alembic_cfg, autogenerate=True, message="Initial migration")
+                    # Create migration with autogenerate to capture the differences
+                    command.revision(alembic_cfg, autogenerate=True, message="Initial migration from existing database")
+            else:
+                logger.info("No existing tables found. Creating fresh migration...")
+                # Create fresh migration
+                command.revision(alembic_cfg, autogenerate=True, message="Initial migration")
             logger.info("Initial migration created successfully.")
+        elif not AUTOGEN_MIGRATIONS:
+            logger.info("Migration autogenerate is disabled, applying existing migrations only.")
         else:
             # Migration files exist, check if we need to create a new migration for schema changes
             logger.info("Migration files exist. Checking for pending schema changes...")
             try:
-                # Create a new migration to detect any schema changes
-                command.revision(alembic_cfg, autogenerate=True, message="Auto-generated migration for schema changes")
-                
-                # Check if the new migration is empty (no changes detected)
-                migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-                if migration_files:
-                    latest_migration = max(migration_files)
-                    migration_path = os.path.join(versions_dir, latest_migration)
-                    
-                    # Check if migration is empty
-                    with open(migration_path, 'r') as f:
-                        content = f.read()
-                        if 'pass' in content and 'op.create_table' not in content and 'op.add_column' not in content and 'op.drop_table' not in content and 'op.drop_column' not in content:
-                            logger.info("No schema changes detected. Removing empty migration...")
-                            # Remove the empty migration
-                            os.remove(migration_path)
-                        else:
-                            logger.info("Schema changes detected. New migration created.")
-                            
+                # Diff the models against the database in memory, and only write
+                # a revision when there is something to migrate
+                if _autogenerate_is_empty():
+                    logger.info("No schema changes detected.")
+                else:
+                    command.revision(alembic_cfg, autogenerate=True, message="Auto-generated migration for schema changes")
+                    logger.info("Schema changes detected. New migration created.")
+
             except Exception as e:
                 logger.info(f"No new migrations needed or error creating migration: {e}")
                 pass
         
         # Check if database is in an inconsistent state (has alembic_version but no tables)
-        engine = create_engine(DATABASE_URL)
-        with engine.connect() as connection:
-            from sqlalchemy import text, inspect
-            inspector = inspect(connection)
-            existing_tables = inspector.get_table_names()
-            
-            # Check if we have alembic_version but no actual tables
-            if 'alembic_version' in existing_tables and len(existing_tables) == 1:
+        if has_alembic_version and not app_table_count:
+            with engine.begin() as connection:
                 logger.info("Database has alembic_version but no actual tables - resetting migration state...")
                 # Clear alembic_version and start fresh
                 connection.execute(text("DELETE FROM alembic_version"))
-                connection.commit()
                 logger.info("Reset migration state - will create fresh migration")
         
         # Run the upgrade command
@@ -137,36 +190,19 @@ def run_migrations():
         try:
             command.upgrade(alembic_cfg, "head")
             logger.info("Database migrations completed successfully.")
+            _write_schema_fingerprint(fingerprint)
         except Exception as upgrade_error:
             if "Can't locate revision identified by 'direct_creation'" in str(upgrade_error):
                 logger.info("Found 'direct_creation' revision - resetting migration state...")
-                # Clear the alembic_version table and start fresh
-                engine = create_engine(DATABASE_URL)
-                with engine.connect() as connection:
-                    from sqlalchemy import text
+                # Find the correct revision for the alembic_version table
+                revision_id = _head_revision(alembic_cfg)
+
+                # Clear the alembic_version table and set the revision in one transaction
+                with engine.begin() as connection:
                     connection.execute(text("DELETE FROM alembic_version"))
-                    connection.commit()
-                
-                # Set the correct revision in alembic_version table
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                versions_dir = os.path.join(current_dir, "alembic", "versions")
-                migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-                
-                if migration_files:
-                    # Get the latest migration file and extract its revision ID
-                    latest_migration = max(migration_files)
-                    migration_path = os.path.join(versions_dir, latest_migration)
-                    
-                    with open(migration_path, 'r') as f:
-                        content = f.read()
-                        # Extract revision ID from the file
-                        import re
-                        revision_match = re.search(r"revision: str = '([^']+)'", content)
-                        if revision_match:
-                            revision_id = revision_match.group(1)
-                            logger.info(f"Setting alembic_version to {revision_id}")
-                            connection.execute(text(f"INSERT INTO alembic_version (version_num) VALUES ('{revision_id}')"))
-                            connection.commit()
+                    if revision_id:
+                        logger.info(f"Setting alembic_version to {revision_id}")
+                        connection.execute(text("INSERT INTO alembic_version (version_num) VALUES (:version_num)"), {"version_num": revision_id})
                 
                 # Try upgrade again
                 command.upgrade(alembic_cfg, "head")
@@ -174,11 +210,8 @@ def run_migrations():
             elif "no such table" in str(upgrade_error).lower():
                 logger.info("Database tables missing - resetting migration state...")
                 # Clear the alembic_version table and start fresh
-                engine = create_engine(DATABASE_URL)
-                with engine.connect() as connection:
-                    from sqlalchemy import text
+                with engine.begin() as connection:
                     connection.execute(text("DELETE FROM alembic_version"))
-                    connection.commit()
                 
                 # Try upgrade again
                 command.upgrade(alembic_cfg, "head")
@@ -191,37 +224,31 @@ def run_migrations():
         # Fully automated recovery - handle ALL error scenarios
         logger.info("Attempting automated recovery...")
         try:
-            # Clear the alembic_version table to reset state
-            engine = create_engine(DATABASE_URL)
-            with engine.connect() as connection:
-                from sqlalchemy import text
-                connection.execute(text("DROP TABLE IF EXISTS alembic_version"))
-                connection.commit()
-            
+            engine = _get_engine()
+
             # Check if we have existing migration files
-            versions_dir = os.path.join(current_dir, "alembic", "versions")
-            migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
+            alembic_cfg = _get_alembic_config()
+            revision_id = _head_revision(alembic_cfg)
             
-            if migration_files:
+            if revision_id:
                 # We have migration files, just fix the alembic_version table
                 logger.info("Found existing migration files, fixing alembic_version table...")
-                latest_migration = max(migration_files)
-                migration_path = os.path.join(versions_dir, latest_migration)
-                
-                with open(migration_path, 'r') as f:
-                    content = f.read()
-                    import re
-                    revision_match = re.search(r"revision: str = '([^']+)'", content)
-                    if revision_match:
-                        revision_id = revision_match.group(1)
-                        logger.info(f"Setting alembic_version to {revision_id}")
-                        connection.execute(text(f"INSERT INTO alembic_version (version_num) VALUES ('{revision_id}')"))
-                        connection.commit()
+
+                # Reset the alembic_version table and set the revision in one transaction
+                with engine.begin() as connection:
+                    connection.execute(text("DROP TABLE IF EXISTS alembic_version"))
+                    logger.info(f"Setting alembic_version to {revision_id}")
+                    connection.execute(text(ALEMBIC_VERSION_DDL))
+                    connection.execute(text("INSERT INTO alembic_version (version_num) VALUES (:version_num)"), {"version_num": revision_id})
                 
                 # Try upgrade again
                 command.upgrade(alembic_cfg, "head")
                 logger.info("Automated recovery completed successfully.")
             else:
+                # Clear the alembic_version table to reset state
+                with engine.begin() as connection:
+                    connection.execute(text("DROP TABLE IF EXISTS alembic_version"))
+
                 # No migration files, create fresh ones
                 logger.info("No migration files found, creating fresh migration...")
                 _create_complete_migration(alembic_cfg)
@@ -238,145 +265,188 @@ def run_migrations():
             logger.info("Database created successfully using fallback method.")
 
 
-def _create_complete_migration(alembic_cfg):
-    """Create a complete migration file with all database schema."""
-    # Create a new migration file
-    command.revision(alembic_cfg, message="Complete schema migration")
-    
-    # Get the latest migration file
-    versions_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic", "versions")
-    migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-    latest_migration = max(migration_files) if migration_files else None
-    
-    if latest_migration:
-        migration_path = os.path.join(versions_dir, latest_migration)
-        _populate_migration_file(migration_path)
+def _autogenerate_is_empty():
+    """True if autogenerate would find no differences between the models and the database."""
+    with _get_engine().connect() as connection:
+        migration_context = MigrationContext.configure(connection)
+        return produce_migrations(migration_context, Base.metadata).upgrade_ops.is_empty()
 
 
-def _populate_migration_file(migration_path):
-    """Populate a migration file with the complete database schema from models."""
+@functools.lru_cache(maxsize=1)
+def _schema_fingerprint():
+    """
+    Stable hash of the DDL the models compile to, which covers columns,
+    server defaults, primary keys, unique and foreign key constraints and indexes.
+    """
+    dialect = _get_engine().dialect
+    ddl = []
+    for table in sorted(_sorted_app_tables(), key=lambda table: table.name):
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(sorted(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes))
+    return hashlib.blake2b("\n".join(ddl).encode(), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _sorted_app_tables():
+    """Model tables in dependency order, parents before the tables that reference them."""
+    return tuple(table for table in Base.metadata.sorted_tables if table.name != 'alembic_version')
+
+
+def _probe_table_state(connection):
+    """Whether alembic_version exists, and how many application tables there are."""
+    # One table listing answers both questions, on any dialect
+    tables = frozenset(inspect(connection).get_table_names())
+    app_tables = {table for table in tables if not table.startswith('sqlite_')} - {'alembic_version'}
+    return 'alembic_version' in tables, len(app_tables)
+
+
+def _get_current_revision():
+    with _get_engine().connect() as connection:
+        return MigrationContext.configure(connection).get_current_revision()
+
+
+def _read_persisted_fingerprint():
+    """[format, fingerprint, revision] from SCHEMA_FINGERPRINT_PATH, read once per process."""
+    global _persisted_fingerprint
+    if _persisted_fingerprint is None:
+        try:
+            with open(SCHEMA_FINGERPRINT_PATH) as f:
+                _persisted_fingerprint = f.read().split()
+        except OSError:
+            _persisted_fingerprint = []
+    return _persisted_fingerprint
+
+
+def _fingerprint_matches(fingerprint, revision):
+    """True if the stored fingerprint was written for these models at this revision."""
+    return _read_persisted_fingerprint() == [SCHEMA_FINGERPRINT_FORMAT, fingerprint, revision]
+
+
+def _write_schema_fingerprint(fingerprint):
+    global _persisted_fingerprint
+    try:
+        current_rev = _get_current_revision()
+        entry = [SCHEMA_FINGERPRINT_FORMAT, fingerprint, str(current_rev)]
+        with open(SCHEMA_FINGERPRINT_PATH, "w") as f:
+            f.write(" ".join(entry) + "\n")
+        _persisted_fingerprint = entry
+    except Exception as e:
+        logger.warning(f"Could not store schema fingerprint: {e}")
+
+
+def _create_complete_migration(alembic_cfg):
+    """Create a complete migration file with all database schema."""
     # Generate the migration content dynamically from models
-    migration_content = _generate_migration_from_models()
-    
-    # Read the current migration file
-    with open(migration_path, 'r') as f:
-        content = f.read()
-    
-    # Add datetime import if needed
-    if "datetime.now" in migration_content and "from datetime import datetime" not in content:
-        # Insert the import after the existing imports
-        import re
-        content = re.sub(
-            r'(from alembic import op\nimport sqlalchemy as sa\n)',
-            r'\1from datetime import datetime\n',
-            content
-        )
-    
-    # Replace the empty upgrade/downgrade functions
-    import re
-    # More flexible regex to match the actual content
-    content = re.sub(
-        r'def upgrade\(\) -> None:.*?pass.*?(?=\n\ndef downgrade|\n\nif __name__|\Z)',
-        migration_content,
-        content,
-        flags=re.DOTALL
+    upgrades, downgrades = _generate_migration_from_models()
+    imports = "from datetime import datetime" if "datetime.now" in upgrades + downgrades else ""
+
+    # Render the new revision with its content in a single write
+    script_dir = ScriptDirectory.from_config(alembic_cfg)
+    script_dir.generate_revision(
+        rev_id(),
+        "Complete schema migration",
+        refresh=True,
+        head="head",
+        upgrades=upgrades,
+        downgrades=downgrades,
+        imports=imports,
     )
-    
-    # Write the updated content back
-    with open(migration_path, 'w') as f:
-        f.write(content)
 
 
 def _generate_migration_from_models():
-    """Generate migration content dynamically from SQLAlchemy models."""
-    from models import Base
-    import sqlalchemy as sa
-    from datetime import datetime
-    
+    """Generate upgrade and downgrade bodies dynamically from SQLAlchemy models."""
     # Generate migration content using Alembic's op functions
     upgrade_statements = []
     downgrade_statements = []
     
-    # Get all tables from Base metadata
-    for table_name, table in Base.metadata.tables.items():
-        if table_name != 'alembic_version':  # Skip alembic_version table
-            # Check if table exists and compare schema
-            schema_diff = _detect_schema_differences(table_name, table)
-            
-            if schema_diff['table_exists']:
-                if schema_diff['needs_update']:
-                    # Generate ALTER TABLE statements for existing table
-                    upgrade_statements.append(f"    # Update {table_name} table schema")
-                    for statement in schema_diff['alter_statements']:
-                        upgrade_statements.append(f"    {statement}")
-                else:
-                    # Table exists and is up to date - skip creating it
-                    upgrade_statements.append(f"    # Table {table_name} already exists and is up to date")
-            else:
-                # Generate CREATE TABLE for new table
-                table_code = _generate_table_creation_code(table_name, table)
-                upgrade_statements.append(f"    # Create {table_name} table")
-                upgrade_statements.append(table_code)
-            
-            # Only add to downgrade if table actually exists
-            if schema_diff['table_exists']:
-                downgrade_statements.append(f"    # op.drop_table('{table_name}')  # Skipped - table exists")
+    # Reflect the columns of every existing table in one sweep
+    existing_columns_map = _reflect_existing_columns()
+
+    # Model tables in dependency order
+    for table in _sorted_app_tables():
+        table_name = table.name
+        # Check if table exists and compare schema
+        schema_diff = _detect_schema_differences(existing_columns_map, table_name, table)
+        
+        if schema_diff['table_exists']:
+            if schema_diff['needs_update']:
+                # Generate ALTER TABLE statements for existing table
+                upgrade_statements.append(f"    # Update {table_name} table schema")
+                for statement in schema_diff['alter_statements']:
+                    upgrade_statements.append(f"    {statement}")
             else:
-                downgrade_statements.append(f"    op.drop_table('{table_name}')")
-    
-    # Combine all statements
-    upgrade_content = "def upgrade() -> None:\n    \"\"\"Upgrade schema.\"\"\"\n" + "\n".join(upgrade_statements)
-    downgrade_content = "def downgrade() -> None:\n    \"\"\"Downgrade schema.\"\"\"\n" + "\n".join(downgrade_statements)
+                # Table exists and is up to date - skip creating it
+                upgrade_statements.append(f"    # Table {table_name} already exists and is up to date")
+        else:
+            # Generate CREATE TABLE for new table
+            table_code = _generate_table_creation_code(table_name, table)
+            upgrade_statements.append(f"    # Create {table_name} table")
+            upgrade_statements.append(table_code)
+        
+        # Only add to downgrade if table actually exists
+        if schema_diff['table_exists']:
+            downgrade_statements.append(f"    # op.drop_table('{table_name}')  # Skipped - table exists")
+        else:
+            downgrade_statements.append(f"    op.drop_table('{table_name}')")
     
-    return upgrade_content + "\n\n" + downgrade_content
+    # Bodies for the upgrade()/downgrade() slots of script.py.mako, which
+    # already indents the first line
+    upgrades = "\n".join(upgrade_statements).lstrip()
+    downgrades = "\n".join(downgrade_statements).lstrip()
 
+    return upgrades, downgrades
 
-def _detect_schema_differences(table_name, expected_table):
+
+def _reflect_existing_columns():
+    """Map every existing table name to the set of its column names."""
+    inspector = inspect(_get_engine())
+    # get_multi_columns is a single query on dialects that support it
+    multi_columns = inspector.get_multi_columns()
+    return {
+        table_name: {col['name'] for col in columns}
+        for (_, table_name), columns in multi_columns.items()
+    }
+
+
+def _detect_schema_differences(existing_columns_map, table_name, expected_table):
     """Detect differences between existing table and expected schema."""
-    engine = create_engine(DATABASE_URL)
-    
-    with engine.connect() as connection:
-        from sqlalchemy import text, inspect
-        
-        # Check if table exists
-        inspector = inspect(connection)
-        if table_name not in inspector.get_table_names():
-            return {
-                'table_exists': False,
-                'needs_update': False,
-                'alter_statements': []
-            }
-        
-        # Get existing columns
-        existing_columns = inspector.get_columns(table_name)
-        existing_column_names = {col['name'] for col in existing_columns}
-        
-        # Get expected columns
-        expected_column_names = {col.name for col in expected_table.columns}
-        
-        # Check for missing columns
-        missing_columns = expected_column_names - existing_column_names
-        extra_columns = existing_column_names - expected_column_names
-        
-        alter_statements = []
-        
-        # Add missing columns
-        for column in expected_table.columns:
-            if column.name in missing_columns:
-                column_def = _generate_column_definition(column)
-                alter_statements.append(f"op.add_column('{table_name}', {column_def})")
-        
-        # Add missing indexes
-        for index in expected_table.indexes:
-            if not index.unique:
-                cols = "', '".join([col.name for col in index.columns])
-                alter_statements.append(f"op.create_index(op.f('ix_{table_name}_{index.name}'), '{table_name}', ['{cols}'], unique=False)")
-        
+    # Check if table exists
+    if table_name not in existing_columns_map:
         return {
-            'table_exists': True,
-            'needs_update': len(alter_statements) > 0,
-            'alter_statements': alter_statements
+            'table_exists': False,
+            'needs_update': False,
+            'alter_statements': []
         }
+    
+    # Get existing columns
+    existing_column_names = existing_columns_map[table_name]
+    
+    # Get expected columns
+    expected_column_names = {col.name for col in expected_table.columns}
+    
+    # Check for missing columns
+    missing_columns = expected_column_names - existing_column_names
+    extra_columns = existing_column_names - expected_column_names
+    
+    alter_statements = []
+    
+    # Add missing columns
+    for column in expected_table.columns:
+        if column.name in missing_columns:
+            column_def = _generate_column_definition(column)
+            alter_statements.append(f"op.add_column('{table_name}', {column_def})")
+    
+    # Add missing indexes
+    for index in expected_table.indexes:
+        if not index.unique:
+            cols = "', '".join([col.name for col in index.columns])
+            alter_statements.append(f"op.create_index(op.f('ix_{table_name}_{index.name}'), '{table_name}', ['{cols}'], unique=False)")
+    
+    return {
+        'table_exists': True,
+        'needs_update': len(alter_statements) > 0,
+        'alter_statements': alter_statements
+    }
 
 
 def _generate_column_definition(column):
@@ -403,222 +473,187 @@ def _generate_column_definition(column):
 
 def _generate_table_creation_code(table_name, table):
     """Generate op.create_table code for a SQLAlchemy table."""
-    lines = [f"    op.create_table('{table_name}',"]
-    
+    cols = tuple(table.columns)
+
     # Collect all table items (columns + constraints)
-    all_items = []
-    
-    # Add columns
-    for column in table.columns:
-        column_def = f"        sa.Column('{column.name}', {_get_column_type(column)}, nullable={column.nullable}"
-        if column.default is not None:
-            # Handle callable defaults properly
-            if hasattr(column.default, 'arg') and callable(column.default.arg):
-                column_def += f", default=datetime.now"
-            else:
-                column_def += f", default={repr(column.default)}"
-        column_def += ")"
-        all_items.append(column_def)
+    all_items = [_generate_create_column_code(column) for column in cols]
     
     # Add constraints
     for constraint in table.constraints:
-        if hasattr(constraint, 'columns'):
-            if constraint.__class__.__name__ == 'PrimaryKeyConstraint':
-                all_items.append(f"        sa.PrimaryKeyConstraint('{constraint.columns.keys()[0]}')")
-            elif constraint.__class__.__name__ == 'UniqueConstraint':
-                cols = "', '".join(constraint.columns.keys())
-                all_items.append(f"        sa.UniqueConstraint('{cols}')")
+        if isinstance(constraint, PrimaryKeyConstraint):
+            all_items.append(f"        sa.PrimaryKeyConstraint('{constraint.columns.keys()[0]}')")
+        elif isinstance(constraint, UniqueConstraint):
+            constraint_cols = "', '".join(constraint.columns.keys())
+            all_items.append(f"        sa.UniqueConstraint('{constraint_cols}')")
     
     # Add foreign key constraints
-    for fk in table.foreign_keys:
-        all_items.append(f"        sa.ForeignKeyConstraint(['{fk.parent.name}'], ['{fk.column.table.name}.{fk.column.name}'], )")
+    all_items.extend(
+        f"        sa.ForeignKeyConstraint(['{fk.parent.name}'], ['{fk.column.table.name}.{fk.column.name}'], )"
+        for fk in table.foreign_keys
+    )
     
     # Add all items with commas (except the last one)
-    for i, item in enumerate(all_items):
-        if i < len(all_items) - 1:
-            item += ","
-        lines.append(item)
-    
+    lines = [f"    op.create_table('{table_name}',"]
+    if all_items:
+        lines.append(",\n".join(all_items))
     lines.append("    )")
     
     # Add indexes with IF NOT EXISTS equivalent using try/except
     for index in table.indexes:
         if not index.unique:
-            cols = "', '".join([col.name for col in index.columns])
+            index_cols = "', '".join([col.name for col in index.columns])
             lines.append(f"    # Create index for {table_name}")
             lines.append(f"    try:")
-            lines.append(f"        op.create_index(op.f('ix_{table_name}_{index.name}'), '{table_name}', ['{cols}'], unique=False)")
+            lines.append(f"        op.create_index(op.f('ix_{table_name}_{index.name}'), '{table_name}', ['{index_cols}'], unique=False)")
             lines.append(f"    except Exception:")
             lines.append(f"        pass  # Index may already exist")
     
     return "\n".join(lines)
 
 
+def _generate_create_column_code(column):
+    """Generate the sa.Column(...) item of an op.create_table call."""
+    column_def = f"        sa.Column('{column.name}', {_get_column_type(column)}, nullable={column.nullable}"
+    if column.default is not None:
+        # Handle callable defaults properly
+        if hasattr(column.default, 'arg') and callable(column.default.arg):
+            column_def += f", default=datetime.now"
+        else:
+            column_def += f", default={repr(column.default)}"
+    return column_def + ")"
+
+
+# Column type class name -> sa.* expression used in generated migrations
+_PY_TYPE_MAP = {
+    'String': lambda column: f"sa.String(length={column.type.length})",
+    'Integer': lambda column: "sa.Integer()",
+    'Text': lambda column: "sa.Text()",
+    'Boolean': lambda column: "sa.Boolean()",
+    'DateTime': lambda column: "sa.DateTime()",
+}
+
+
 def _get_column_type(column):
     """Get SQLAlchemy column type string."""
     type_name = column.type.__class__.__name__
-    
-    if type_name == 'String':
-        return f"sa.String(length={column.type.length})"
-    elif type_name == 'Integer':
-        return "sa.Integer()"
-    elif type_name == 'Text':
-        return "sa.Text()"
-    elif type_name == 'Boolean':
-        return "sa.Boolean()"
-    elif type_name == 'DateTime':
-        return "sa.DateTime()"
-    else:
-        return f"sa.{type_name}()"
+    formatter = _PY_TYPE_MAP.get(type_name)
+    return formatter(column) if formatter else f"sa.{type_name}()"
 
 
 def _create_database_directly():
     """Fallback method: create database directly using SQLAlchemy."""
-    from models import Base
-    from db import engine
-    from sqlalchemy import text, inspect
-    
-    # Check existing tables and update schema
-    with engine.connect() as connection:
+    engine = _get_engine()
+
+    # Get the correct revision ID from existing migration files before the
+    # write transaction starts, so file I/O doesn't extend the lock
+    revision_id = _head_revision(_get_alembic_config())
+
+    # Check existing tables and update schema, committed once at the end
+    with engine.begin() as connection:
         inspector = inspect(connection)
-        existing_tables = inspector.get_table_names()
+        existing_tables = frozenset(inspector.get_table_names())
         
         # For each model table, check if it needs updates
-        for table_name, table in Base.metadata.tables.items():
-            if table_name != 'alembic_version':
-                if table_name in existing_tables:
-                    # Table exists, check for missing columns
-                    existing_columns = {col['name'] for col in inspector.get_columns(table_name)}
-                    expected_columns = {col.name for col in table.columns}
-                    missing_columns = expected_columns - existing_columns
-                    
-                    # Add missing columns
-                    for column in table.columns:
-                        if column.name in missing_columns:
-                            # Convert to raw SQL for direct execution
-                            sql_type = _get_sql_type(column)
-                            nullable = "NULL" if column.nullable else "NOT NULL"
+        for table in _sorted_app_tables():
+            table_name = table.name
+            if table_name in existing_tables:
+                # Table exists, check for missing columns
+                existing_columns = {col['name'] for col in inspector.get_columns(table_name)}
+                expected_columns = {col.name for col in table.columns}
+                missing_columns = expected_columns - existing_columns
+                # Added datetime columns, backfilled together below
+                timestamp_columns = []
+                
+                # Add missing columns
+                for column in table.columns:
+                    if column.name in missing_columns:
+                        # Convert to raw SQL for direct execution
+                        sql_type = _get_sql_type(column)
+                        nullable = "NULL" if column.nullable else "NOT NULL"
+                        
+                        # Handle datetime columns without default (SQLite limitation)
+                        if column.type.__class__.__name__ == 'DateTime':
+                            # Add column without default, then update existing rows
+                            alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {sql_type} {nullable}"
+                            try:
+                                connection.execute(text(alter_sql))
+                                logger.info(f"Added column {column.name} to {table_name}")
+                                timestamp_columns.append(column.name)
+                            except Exception as e:
+                                logger.error(f"Could not add column {column.name}: {e}")
+                        else:
+                            # Handle other column types with defaults
+                            default_clause = ""
+                            if column.default is not None:
+                                if hasattr(column.default, 'arg') and callable(column.default.arg):
+                                    # Skip callable defaults for SQLite compatibility
+                                    pass
+                                elif hasattr(column.default, 'arg'):
+                                    default_clause = f" DEFAULT {repr(column.default.arg)}"
                             
-                            # Handle datetime columns without default (SQLite limitation)
-                            if column.type.__class__.__name__ == 'DateTime':
-                                # Add column without default, then update existing rows
-                                alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {sql_type} {nullable}"
-                                try:
-                                    connection.execute(text(alter_sql))
-                                    logger.info(f"Added column {column.name} to {table_name}")
-                                    
-                                    # Update existing rows with current timestamp
-                                    update_sql = f"UPDATE {table_name} SET {column.name} = CURRENT_TIMESTAMP WHERE {column.name} IS NULL"
-                                    connection.execute(text(update_sql))
-                                    logger.info(f"Updated {column.name} with current timestamp")
-                                except Exception as e:
-                                    logger.error(f"Could not add column {column.name}: {e}")
-                            else:
-                                # Handle other column types with defaults
-                                default_clause = ""
-                                if column.default is not None:
-                                    if hasattr(column.default, 'arg') and callable(column.default.arg):
-                                        # Skip callable defaults for SQLite compatibility
-                                        pass
-                                    elif hasattr(column.default, 'arg'):
-                                        default_clause = f" DEFAULT {repr(column.default.arg)}"
-                                
-                                alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {sql_type} {nullable}{default_clause}"
-                                try:
-                                    connection.execute(text(alter_sql))
-                                    logger.info(f"Added column {column.name} to {table_name}")
-                                except Exception as e:
-                                    logger.error(f"Could not add column {column.name}: {e}")
-                else:
-                    # Table doesn't exist, create it
-                    logger.info(f"Creating table {table_name}")
+                            alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {sql_type} {nullable}{default_clause}"
+                            try:
+                                connection.execute(text(alter_sql))
+                                logger.info(f"Added column {column.name} to {table_name}")
+                            except Exception as e:
+                                logger.error(f"Could not add column {column.name}: {e}")
+
+                # Update existing rows with current timestamp, one statement per table
+                if timestamp_columns:
+                    assignments = ", ".join(f"{name} = COALESCE({name}, CURRENT_TIMESTAMP)" for name in timestamp_columns)
+                    conditions = " OR ".join(f"{name} IS NULL" for name in timestamp_columns)
+                    try:
+                        connection.execute(text(f"UPDATE {table_name} SET {assignments} WHERE {conditions}"))
+                        logger.info(f"Updated {', '.join(timestamp_columns)} with current timestamp")
+                    except Exception as e:
+                        logger.error(f"Could not backfill timestamps in {table_name}: {e}")
+            else:
+                # Table doesn't exist, create it
+                logger.info(f"Creating table {table_name}")
         
         # Create alembic_version table manually
-        connection.execute(text("""
-            CREATE TABLE IF NOT EXISTS alembic_version (
-                version_num VARCHAR(32) NOT NULL,
-                CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num)
-            )
-        """))
-        
-        # Get the correct revision ID from existing migration files
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        versions_dir = os.path.join(current_dir, "alembic", "versions")
-        migration_files = [f for f in os.listdir(versions_dir) if f.endswith('.py') and not f.startswith('__')]
-        
-        if migration_files:
-            latest_migration = max(migration_files)
-            migration_path = os.path.join(versions_dir, latest_migration)
-            
-            with open(migration_path, 'r') as f:
-                content = f.read()
-                import re
-                revision_match = re.search(r"revision: str = '([^']+)'", content)
-                if revision_match:
-                    revision_id = revision_match.group(1)
-                    connection.execute(text(f"INSERT OR IGNORE INTO alembic_version (version_num) VALUES ('{revision_id}')"))
-                else:
-                    connection.execute(text("INSERT OR IGNORE INTO alembic_version (version_num) VALUES ('direct_creation')"))
-        else:
-            connection.execute(text("INSERT OR IGNORE INTO alembic_version (version_num) VALUES ('direct_creation')"))
-        
-        connection.commit()
+        connection.execute(text(ALEMBIC_VERSION_DDL))
+        connection.execute(
+            text("INSERT OR IGNORE INTO alembic_version (version_num) VALUES (:version_num)"),
+            {"version_num": revision_id or "direct_creation"},
+        )
+
+
+# Column type class name -> SQL type used by the direct-creation fallback
+_SQL_TYPE_MAP = {
+    'String': lambda column: f"VARCHAR({column.type.length})",
+    'Integer': lambda column: "INTEGER",
+    'Text': lambda column: "TEXT",
+    'Boolean': lambda column: "BOOLEAN",
+    'DateTime': lambda column: "DATETIME",
+}
 
 
 def _get_sql_type(column):
     """Get SQL type for direct SQL execution."""
-    type_name = column.type.__class__.__name__
-    
-    if type_name == 'String':
-        return f"VARCHAR({column.type.length})"
-    elif type_name == 'Integer':
-        return "INTEGER"
-    elif type_name == 'Text':
-        return "TEXT"
-    elif type_name == 'Boolean':
-        return "BOOLEAN"
-    elif type_name == 'DateTime':
-        return "DATETIME"
-    else:
-        return "TEXT"  # fallback
-
-
-def check_migration_status():
+    formatter = _SQL_TYPE_MAP.get(column.type.__class__.__name__)
+    return formatter(column) if formatter else "TEXT"  # fallback
+
+
+def check_migration_status(alembic_cfg=None):
     """
     Check if the database needs migrations.
-    Returns True if migrations are needed, False otherwise.
+    Returns (needs_migration, current_rev, head_rev).
     """
     try:
-        # Create engine
-        engine = create_engine(DATABASE_URL)
-        
-        # Check if alembic_version table exists
-        with engine.connect() as connection:
-            # Check if alembic_version table exists
-            from sqlalchemy import text
-            result = connection.execute(
-                text("SELECT name FROM sqlite_master WHERE type='table' AND name='alembic_version'")
-            )
-            alembic_table_exists = result.fetchone() is not None
-            
-            if not alembic_table_exists:
-                return True
-            
-            # Get current migration context
-            context = MigrationContext.configure(connection)
-            current_rev = context.get_current_revision()
-            
-            # Get the latest revision from alembic
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            alembic_cfg = Config(os.path.join(current_dir, "alembic.ini"))
-            script_dir = command.ScriptDirectory.from_config(alembic_cfg)
-            head_rev = script_dir.get_current_head()
-            
-            return current_rev != head_rev
+        # Get the latest revision from the scripts, no database needed
+        if alembic_cfg is None:
+            alembic_cfg = _get_alembic_config()
+        head_rev = ScriptDirectory.from_config(alembic_cfg).get_current_head()
+
+        # None if alembic_version doesn't exist yet
+        current_rev = _get_current_revision()
+
+        return current_rev is None or current_rev != head_rev, current_rev, head_rev
             
     except Exception as e:
         logger.error(f"Error checking migration status: {e}")
-        return True  # Assume migrations are needed if we can't check
+        return True, None, None  # Assume migrations are needed if we can't check
 
 
 if __name__ == "__main__":
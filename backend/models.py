@@ -105,7 +105,7 @@ class PushSubscription(Base):
     __tablename__ = "push_subscription"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False, index=True)
     endpoint = Column(Text, nullable=False)
     p256dh_key = Column(Text, nullable=False)
     auth_key = Column(Text, nullable=False)
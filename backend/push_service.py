@@ -1,18 +1,56 @@
+import asyncio
 import json
 import logging
 import os
+import time
+from collections import defaultdict
 from typing import List, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from pywebpush import webpush, WebPushException
+from py_vapid import Vapid
 from models import PushSubscription, User, Message, DMEnvelope
 from models import FcmToken
+from db import SessionLocal
 import firebase_admin
 from firebase_admin import credentials as firebase_credentials
 from firebase_admin import messaging as firebase_messaging
 import base64
+import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger("uvicorn.error")
 
+# Most messages FCM accepts in one batch request
+FCM_BATCH_LIMIT = 500
+# Most tokens FCM accepts in one topic (un)subscribe request
+FCM_TOPIC_BATCH_LIMIT = 1000
+
+# With this on, public messages reach Android devices as a single message to a
+# topic all registered tokens are subscribed to (stored tokens at startup, new
+# ones as they register). The app has to drop public messages whose sender_id
+# is the signed-in user, as the sender's devices are subscribed too.
+FCM_PUBLIC_CHAT_TOPIC_ENABLED = os.getenv("FCM_PUBLIC_CHAT_TOPIC", "0") == "1"
+FCM_PUBLIC_CHAT_TOPIC = "public_chat"
+
+# Push requests in flight at once, across all notifications being sent
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "16"))
+
+# Signed VAPID headers are reused until shortly before their token expires
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60
+VAPID_RENEW_BEFORE = 60 * 60
+
+# Scheduled notifications are collected for this long and then sent together,
+# sharing their recipient lookups and FCM requests
+PUSH_BATCH_WINDOW_SECONDS = 0.02
+PUSH_BATCH_MAX_SIZE = 100
+# Batches sent at once, so a large public fan-out doesn't hold up the DMs queued
+# behind it; each one holds a database connection while it sends
+PUSH_BATCHES_IN_FLIGHT = int(os.getenv("PUSH_BATCHES_IN_FLIGHT", "4"))
+# Notifications waiting to be batched; more than this are dropped
+PUSH_QUEUE_SIZE = int(os.getenv("PUSH_QUEUE_SIZE", "10000"))
+# How long shutdown waits for queued notifications to be sent
+PUSH_SHUTDOWN_TIMEOUT_SECONDS = 10
+
 class PushNotificationService:
     def __init__(self):
         self.vapid_private_key = os.getenv("VAPID_PRIVATE_KEY")
@@ -43,6 +81,23 @@ class PushNotificationService:
             "sub": "mailto:support@fromchat.ru",
             "aud": "https://fcm.googleapis.com"
         }
+        # Parse the key once; headers are signed by _get_vapid_headers
+        self.vapid = Vapid.from_string(private_key=self.vapid_private_key)
+        self.vapid_headers = None
+        self.vapid_expires_at = 0
+
+        # Shared session so web pushes reuse keep-alive connections to the push services,
+        # with enough pooled connections per service for every concurrent send
+        self.webpush_session = requests.Session()
+        self.webpush_session.mount("https://", HTTPAdapter(pool_maxsize=PUSH_CONCURRENCY))
+        # Scheduled notifications, drained by batch_worker into batch_tasks, and the
+        # semaphores bounding them; created on first use, inside the running event
+        # loop, and reset by stop()
+        self.queue = None
+        self.batch_worker = None
+        self.batch_slots = None
+        self.send_semaphore = None
+        self.batch_tasks = set()
 
     async def subscribe_user(self, db: Session, user_id: int, endpoint: str, p256dh_key: str, auth_key: str) -> bool:
         """Subscribe a user to push notifications"""
@@ -73,79 +128,198 @@ class PushNotificationService:
             db.rollback()
             return False
 
-    async def send_public_message_notification(self, db: Session, message: Message, exclude_user_id: Optional[int] = None):
-        """Send push notification for a new public chat message"""
+    def schedule_public_message_notification(self, message_id: int, exclude_user_id: Optional[int] = None):
+        """Queue public message notifications, sent in the background without holding up the sender's request"""
+        self._enqueue(("public_message", message_id, exclude_user_id))
+
+    def schedule_dm_notification(self, dm_envelope_id: int, sender_id: int):
+        """Queue a DM notification, sent in the background without holding up the sender's request"""
+        self._enqueue(("dm", dm_envelope_id, sender_id))
+
+    def _enqueue(self, job: tuple):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=PUSH_QUEUE_SIZE)
+            self.batch_slots = asyncio.Semaphore(PUSH_BATCHES_IN_FLIGHT)
+            self.send_semaphore = asyncio.Semaphore(PUSH_CONCURRENCY)
+        if self.batch_worker is None or self.batch_worker.done():
+            self.batch_worker = asyncio.create_task(self._run_batches())
         try:
-            # Get all users except the sender
-            users = db.query(User).filter(User.id != message.user_id)
-            if exclude_user_id:
-                users = users.filter(User.id != exclude_user_id)
-
-            for user in users:
-                # Check if user has push subscription before trying to send
-                # Try all FCM tokens first (Android). If none or all fail, fall back to web push subscription.
-                fcm_rows = db.query(FcmToken).filter(FcmToken.user_id == user.id).all()
-                payload_data = {
-                    "type": "public_message",
-                    "message_id": message.id,
-                    "sender_id": message.user_id,
-                    "sender_username": message.author.username
-                }
-                title = f"{message.author.username}"
-                body = message.content[:100] + ("..." if len(message.content) > 100 else "")
-
-                if fcm_rows and self.firebase_initialized:
-                    for fcm in fcm_rows:
-                        try:
-                            self._send_fcm_to_token(fcm.token, title, body, payload_data)
-                        except Exception as e:
-                            logger.error(f"Failed to send FCM to user {user.id} token {fcm.token}: {e}")
-                            # Check if this is a permanent failure and clean up the token
-                            self._cleanup_failed_fcm_token(db, fcm, str(e))
-
-                subscription = db.query(PushSubscription).filter(PushSubscription.user_id == user.id).first()
-                if subscription:
-                    await self._send_notification_to_user(
-                        db, user.id, title, body, message.author.profile_picture, payload_data
-                    )
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Push notification queue is full, dropping {job[0]} notification {job[1]}")
+
+    async def _run_batches(self):
+        """Send queued notifications in batches, so notifications for messages sent close
+        together share their database queries and FCM requests"""
+        while True:
+            jobs = [await self.queue.get()]
+            await asyncio.sleep(PUSH_BATCH_WINDOW_SECONDS)
+            while len(jobs) < PUSH_BATCH_MAX_SIZE and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+
+            await self.batch_slots.acquire()
+            task = asyncio.create_task(self._send_batch_in_slot(jobs))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def _send_batch_in_slot(self, jobs: List[tuple]):
+        try:
+            await self._send_batch(jobs)
         except Exception as e:
-            logger.error(f"Failed to send public message notifications: {e}")
+            logger.error(f"Failed to send a batch of {len(jobs)} push notifications: {e}")
+        finally:
+            self.batch_slots.release()
+            for _ in jobs:
+                self.queue.task_done()
+
+    async def stop(self):
+        """Send the queued notifications, waiting up to PUSH_SHUTDOWN_TIMEOUT_SECONDS, and stop the batch worker"""
+        if self.queue is None:
+            return
 
-    async def send_dm_notification(self, db: Session, dm_envelope: DMEnvelope, sender: User):
-        """Send push notification for a new DM"""
         try:
-            title = f"{sender.username}"
-            body = "New direct message"
-            payload_data = {
+            await asyncio.wait_for(self.queue.join(), PUSH_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Push notifications still pending at shutdown were dropped ({self.queue.qsize()} queued)")
+
+        tasks = [self.batch_worker, *self.batch_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.queue = None
+        self.batch_worker = None
+        self.batch_slots = None
+        self.send_semaphore = None
+
+    async def _send_batch(self, jobs: List[tuple]):
+        """Load the messages behind a batch of queued notifications and send them"""
+        message_ids = {object_id for kind, object_id, _ in jobs if kind == "public_message"}
+        dm_envelope_ids = {object_id for kind, object_id, _ in jobs if kind == "dm"}
+        sender_ids = {sender_id for kind, _, sender_id in jobs if kind == "dm"}
+
+        # The requests' sessions are closed by the time this runs, so use a separate one
+        with SessionLocal() as db:
+            messages = {}
+            if message_ids:
+                messages = {
+                    message.id: message
+                    for message in db.query(Message).options(joinedload(Message.author)).filter(Message.id.in_(message_ids))
+                }
+            dm_envelopes = {}
+            senders = {}
+            if dm_envelope_ids:
+                dm_envelopes = {env.id: env for env in db.query(DMEnvelope).filter(DMEnvelope.id.in_(dm_envelope_ids))}
+                senders = {user.id: user for user in db.query(User).filter(User.id.in_(sender_ids))}
+
+            notifications = []
+            for kind, object_id, extra in jobs:
+                if kind == "public_message":
+                    message = messages.get(object_id)
+                    if message:
+                        notifications.append(self._public_message_notification(message, extra))
+                else:
+                    dm_envelope = dm_envelopes.get(object_id)
+                    sender = senders.get(extra)
+                    if dm_envelope and sender:
+                        notifications.append(self._dm_notification(dm_envelope, sender))
+
+            if notifications:
+                await self._deliver(db, notifications)
+
+    @staticmethod
+    def _public_message_notification(message: Message, exclude_user_id: Optional[int]) -> dict:
+        """Notification for everyone except the sender of a public message"""
+        # Plain values only; a commit while cleaning up a dead token or subscription
+        # would expire the ORM objects and reload them on the next access
+        author = message.author
+        excluded_user_ids = {message.user_id}
+        if exclude_user_id:
+            excluded_user_ids.add(exclude_user_id)
+
+        return {
+            "recipient_id": None,
+            "excluded_user_ids": excluded_user_ids,
+            "title": f"{author.username}",
+            "body": message.content[:100] + ("..." if len(message.content) > 100 else ""),
+            "icon": author.profile_picture,
+            "data": {
+                "type": "public_message",
+                "message_id": message.id,
+                "sender_id": message.user_id,
+                "sender_username": author.username
+            },
+        }
+
+    @staticmethod
+    def _dm_notification(dm_envelope: DMEnvelope, sender: User) -> dict:
+        """Notification for the recipient of a DM"""
+        return {
+            "recipient_id": dm_envelope.recipient_id,
+            "excluded_user_ids": set(),
+            "title": f"{sender.username}",
+            "body": "New direct message",
+            "icon": sender.profile_picture,
+            "data": {
                 "type": "dm",
                 "dm_id": dm_envelope.id,
                 "sender_id": sender.id,
                 "sender_username": sender.username
-            }
+            },
+        }
 
-            fcm_rows = db.query(FcmToken).filter(FcmToken.user_id == dm_envelope.recipient_id).all()
-            if fcm_rows and self.firebase_initialized:
-                for fcm in fcm_rows:
-                    try:
-                        self._send_fcm_to_token(fcm.token, title, body, payload_data)
-                    except Exception as e:
-                        logger.error(f"Failed to send FCM to user {dm_envelope.recipient_id} token {fcm.token}: {e}")
-                        # Check if this is a permanent failure and clean up the token
-                        self._cleanup_failed_fcm_token(db, fcm, str(e))
-
-            await self._send_notification_to_user(
-                db, dm_envelope.recipient_id, title, body, sender.profile_picture, payload_data
-            )
-        except Exception as e:
-            logger.error(f"Failed to send DM notification: {e}")
+    async def _deliver(self, db: Session, notifications: List[dict]):
+        """Send notifications, loading the FCM tokens and web push subscriptions
+        of all their recipients with one query each"""
+        # Public messages go to everyone, so only DMs alone narrow down the lookup
+        recipient_ids = {notification["recipient_id"] for notification in notifications}
+        fcm_query = db.query(FcmToken)
+        subscription_query = db.query(PushSubscription)
+        if None not in recipient_ids:
+            fcm_query = fcm_query.filter(FcmToken.user_id.in_(recipient_ids))
+            subscription_query = subscription_query.filter(PushSubscription.user_id.in_(recipient_ids))
+        elif FCM_PUBLIC_CHAT_TOPIC_ENABLED:
+            # Public messages go to the topic, only DM recipients need their tokens
+            fcm_query = fcm_query.filter(FcmToken.user_id.in_(recipient_ids - {None}))
 
-    async def _send_notification_to_user(self, db: Session, user_id: int, title: str, body: str, icon: Optional[str], data: dict):
-        """Send a push notification to a specific user"""
-        try:
-            subscription = db.query(PushSubscription).filter(PushSubscription.user_id == user_id).first()
-            if not subscription:
-                return
+        fcm_rows_by_user = defaultdict(list)
+        for fcm in fcm_query:
+            fcm_rows_by_user[fcm.user_id].append(fcm)
+        subscriptions = {subscription.user_id: subscription for subscription in subscription_query}
+
+        # Android devices get FCM, browsers get web push
+        sends = []
+        fcm_messages = []
+        for notification in notifications:
+            if notification["recipient_id"] is None:
+                user_ids = (fcm_rows_by_user.keys() | subscriptions.keys()) - notification["excluded_user_ids"]
+            else:
+                user_ids = {notification["recipient_id"]}
+
+            title, body, data = notification["title"], notification["body"], notification["data"]
+            fcm_data = self._fcm_data(title, body, data)
+            to_topic = notification["recipient_id"] is None and FCM_PUBLIC_CHAT_TOPIC_ENABLED
+            if to_topic:
+                fcm_messages.append((None, self._fcm_message(fcm_data, topic=FCM_PUBLIC_CHAT_TOPIC)))
+            for user_id in user_ids:
+                if not to_topic:
+                    fcm_messages.extend(
+                        (fcm, self._fcm_message(fcm_data, token=fcm.token)) for fcm in fcm_rows_by_user.get(user_id, ())
+                    )
+                subscription = subscriptions.get(user_id)
+                if subscription:
+                    sends.append(self._send_webpush(db, user_id, subscription, title, body, notification["icon"], data))
+
+        # FCM messages of every notification share batch requests
+        if fcm_messages and self.firebase_initialized:
+            sends.append(self._send_fcm_messages(db, fcm_messages))
+
+        # Sends run concurrently, bounded by send_semaphore
+        await asyncio.gather(*sends, return_exceptions=True)
 
+    async def _send_webpush(self, db: Session, user_id: int, subscription: PushSubscription, title: str, body: str, icon: Optional[str], data: dict):
+        """Send a web push notification to one of the user's subscriptions"""
+        try:
             payload = {
                 "title": title,
                 "body": body,
@@ -162,12 +336,15 @@ class PushNotificationService:
                 }
             }
 
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps(payload),
-                vapid_private_key=self.vapid_private_key,
-                vapid_claims=self.vapid_claims
-            )
+            # pywebpush is blocking; keep the request off the event loop
+            async with self.send_semaphore:
+                await asyncio.to_thread(
+                    webpush,
+                    subscription_info=subscription_info,
+                    data=json.dumps(payload),
+                    headers=self._get_vapid_headers(),
+                    requests_session=self.webpush_session
+                )
             
         except WebPushException as e:
             logger.error(f"WebPush error for user {user_id}: {e}")
@@ -178,6 +355,16 @@ class PushNotificationService:
         except Exception as e:
             logger.error(f"Failed to send push notification to user {user_id}: {e}")
 
+    def _get_vapid_headers(self) -> dict:
+        """VAPID authorization headers, signed once and reused until shortly before they expire"""
+        now = int(time.time())
+        if now >= self.vapid_expires_at - VAPID_RENEW_BEFORE:
+            expires_at = now + VAPID_TOKEN_LIFETIME
+            self.vapid_headers = self.vapid.sign({**self.vapid_claims, "exp": expires_at})
+            self.vapid_expires_at = expires_at
+        # Copy, pywebpush adds its per-message encryption headers to the dict it's given
+        return dict(self.vapid_headers)
+
     def _send_fcm_to_token(self, token: str, title: str, body: str, data: dict):
         """Send an FCM data-only push to a single device token using Firebase Admin SDK.
         Notification display is handled by the app, not FCM."""
@@ -185,24 +372,101 @@ class PushNotificationService:
             raise RuntimeError("Firebase Admin SDK not initialized (FIREBASE_CERT required)")
 
         try:
-            # Send only data payload - let the app handle notification display
-            # This prevents FCM from auto-showing notifications
-            msg = firebase_messaging.Message(
-                token=token,
-                data={
-                    "title": title,
-                    "body": body,
-                    **{k: str(v) for k, v in (data or {}).items()}
-                },
-                android=firebase_messaging.AndroidConfig(priority="high"),
-                apns=firebase_messaging.APNSConfig(headers={"apns-priority": "10"})
-            )
+            msg = self._fcm_message(self._fcm_data(title, body, data), token=token)
             resp = firebase_messaging.send(msg)
             return resp
         except Exception as e:
             logger.error(f"Firebase Admin send failed for token {token}: {e}")
             raise
 
+    async def _send_fcm_messages(self, db: Session, fcm_messages: List[tuple]):
+        """Send FCM messages, given as (FcmToken row or None for a topic, message) pairs, FCM_BATCH_LIMIT per request.
+        Tokens that failed permanently are removed."""
+        if not self.firebase_initialized:
+            raise RuntimeError("Firebase Admin SDK not initialized (FIREBASE_CERT required)")
+
+        for start in range(0, len(fcm_messages), FCM_BATCH_LIMIT):
+            batch = fcm_messages[start:start + FCM_BATCH_LIMIT]
+            messages = [message for _, message in batch]
+            try:
+                # The Admin SDK is blocking; only the request runs in a worker thread,
+                # token cleanup below stays on the event loop with the session
+                async with self.send_semaphore:
+                    batch_response = await asyncio.to_thread(firebase_messaging.send_each, messages)
+            except Exception as e:
+                logger.error(f"Firebase Admin batch send failed for {len(batch)} messages: {e}")
+                continue
+
+            # Responses are in the same order as the messages
+            for (fcm, message), resp in zip(batch, batch_response.responses):
+                if resp.success:
+                    continue
+                error = resp.exception
+                if fcm is None:
+                    logger.error(f"Failed to send FCM to topic {message.topic}: {error}")
+                    continue
+                logger.error(f"Failed to send FCM to user {fcm.user_id} token {fcm.token}: {error}")
+                # The error class and code name the failure, the message alone often doesn't
+                self._cleanup_failed_fcm_token(db, fcm, f"{type(error).__name__} {getattr(error, 'code', '')}: {error}")
+
+    @staticmethod
+    def _fcm_message(fcm_data: dict, token: Optional[str] = None, topic: Optional[str] = None) -> firebase_messaging.Message:
+        """FCM message for one device token or a topic.
+        Notification display is handled by the app, not FCM."""
+        # Send only data payload - let the app handle notification display
+        # This prevents FCM from auto-showing notifications
+        return firebase_messaging.Message(
+            token=token,
+            topic=topic,
+            data=fcm_data,
+            android=firebase_messaging.AndroidConfig(priority="high"),
+            apns=firebase_messaging.APNSConfig(headers={"apns-priority": "10"})
+        )
+
+    @staticmethod
+    def _fcm_data(title: str, body: str, data: dict) -> dict:
+        """FCM data payload; all values must be strings."""
+        return {
+            "title": title,
+            "body": body,
+            **{k: str(v) for k, v in (data or {}).items()}
+        }
+
+    async def subscribe_to_public_chat_topic(self, tokens: List[str]):
+        """Subscribe FCM tokens to the public chat topic, if public messages are sent to it"""
+        await self._manage_public_chat_topic(firebase_messaging.subscribe_to_topic, tokens)
+
+    async def unsubscribe_from_public_chat_topic(self, tokens: List[str]):
+        """Unsubscribe FCM tokens from the public chat topic, if public messages are sent to it"""
+        await self._manage_public_chat_topic(firebase_messaging.unsubscribe_from_topic, tokens)
+
+    async def subscribe_stored_tokens_to_public_chat_topic(self):
+        """Subscribe every registered FCM token to the public chat topic, if public messages are sent to it.
+        Run at startup, as tokens registered before the topic was enabled are not subscribed yet."""
+        if not (FCM_PUBLIC_CHAT_TOPIC_ENABLED and self.firebase_initialized):
+            return
+
+        with SessionLocal() as db:
+            tokens = [token for (token,) in db.query(FcmToken.token)]
+        await self.subscribe_to_public_chat_topic(tokens)
+        logger.info(f"Subscribed {len(tokens)} FCM tokens to topic {FCM_PUBLIC_CHAT_TOPIC}")
+
+    async def _manage_public_chat_topic(self, operation, tokens: List[str]):
+        if not (FCM_PUBLIC_CHAT_TOPIC_ENABLED and self.firebase_initialized and tokens):
+            return
+
+        for start in range(0, len(tokens), FCM_TOPIC_BATCH_LIMIT):
+            batch = tokens[start:start + FCM_TOPIC_BATCH_LIMIT]
+            try:
+                response = await asyncio.to_thread(operation, batch, FCM_PUBLIC_CHAT_TOPIC)
+                if response.failure_count:
+                    logger.warning(
+                        f"{operation.__name__} failed for {response.failure_count} of {len(batch)} FCM tokens: "
+                        f"{[error.reason for error in response.errors]}"
+                    )
+            except Exception as e:
+                logger.error(f"{operation.__name__} failed for {len(batch)} FCM tokens: {e}")
+
     def _cleanup_failed_fcm_token(self, db: Session, fcm_token_entry, error_message: str):
         """Clean up FCM tokens that have permanent failures"""
         try:
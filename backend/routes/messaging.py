@@ -392,10 +392,7 @@ async def _send_message_internal(
         db.refresh(new_message)
 
     # Send push notifications for public messages
-    try:
-        await push_service.send_public_message_notification(db, new_message, exclude_user_id=current_user.id)
-    except Exception as e:
-        logger.error(f"Failed to send push notification for message {new_message.id}: {e}")
+    push_service.schedule_public_message_notification(new_message.id, exclude_user_id=current_user.id)
 
     # Realtime broadcast for HTTP uploads as well
     try:
@@ -486,6 +483,8 @@ async def register_fcm_token(request: Request, body: RegisterFcmRequest, current
             pass
         raise HTTPException(status_code=500, detail="Failed to save token")
 
+    await push_service.subscribe_to_public_chat_topic([token])
+
     return {"status": "success"}
 
 
@@ -496,10 +495,11 @@ async def unregister_fcm_token(request: Request, body: RegisterFcmRequest | None
     If no token provided, remove all tokens for the user.
     """
     try:
+        token_query = db.query(FcmToken).filter(FcmToken.user_id == current_user.id)
         if body and body.token:
-            db.query(FcmToken).filter(FcmToken.user_id == current_user.id, FcmToken.token == body.token.strip()).delete()
-        else:
-            db.query(FcmToken).filter(FcmToken.user_id == current_user.id).delete()
+            token_query = token_query.filter(FcmToken.token == body.token.strip())
+        tokens = [token for (token,) in token_query.with_entities(FcmToken.token)]
+        token_query.delete()
         db.commit()
     except Exception as e:
         try:
@@ -508,6 +508,8 @@ async def unregister_fcm_token(request: Request, body: RegisterFcmRequest | None
             pass
         raise HTTPException(status_code=500, detail="Failed to remove token")
 
+    await push_service.unsubscribe_from_public_chat_topic(tokens)
+
     return {"status": "success"}
 
 
@@ -529,7 +531,7 @@ async def push_test(request: Request, current_user: User = Depends(get_current_u
         failures = []
         for fcm in fcm_rows:
             try:
-                push_service._send_fcm_to_token(fcm.token, title, body, data)
+                await asyncio.to_thread(push_service._send_fcm_to_token, fcm.token, title, body, data)
             except Exception as e:
                 logger.error(f"Failed to send test push to user {current_user.id} token {fcm.token}: {e}")
                 failures.append(str(e))
@@ -705,10 +707,7 @@ async def dm_send(
         db.refresh(env)
 
     # Send push notification for DM
-    try:
-        await push_service.send_dm_notification(db, env, current_user)
-    except Exception as e:
-        logger.error(f"Failed to send push notification for DM {env.id}: {e}")
+    push_service.schedule_dm_notification(env.id, current_user.id)
 
     # Realtime notify both users for HTTP requests
     try:
@@ -137,16 +137,31 @@ async def get_user_profile(
 
 @router.get("/user/list")
 async def list_users(
+    limit: int | None = None,
+    cursor: str | None = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """
+    List users ordered by username. Pass `limit` to page through the table;
+    `next_cursor` is the username to send as `cursor` for the following page.
+    """
     if current_user.id != 1:
         raise HTTPException(status_code=403, detail="Only admin can list users")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
 
     _ensure_owner_unsuspended(current_user, db)
 
-    users = db.query(User).order_by(User.username.asc()).all()
+    query = db.query(User).order_by(User.username.asc())
+    if cursor:
+        query = query.filter(User.username > cursor)
+    if limit is not None:
+        query = query.limit(limit)
+    users = query.all()
+    next_cursor = users[-1].username if limit is not None and len(users) == limit else None
     return {
+        "next_cursor": next_cursor,
         "users": [
             UserProfileResponse(
                 id=user.id,
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
 import time
 from typing import Callable
 from fastapi import Request
@@ -20,10 +21,20 @@ def get_ip_key(request: Request) -> str:
 # Note: We don't set default_limits to avoid affecting all users if one IP is attacked.
 # Each endpoint should have an explicit rate limit based on its sensitivity.
 # Rate limits automatically expire after the time window - IPs are not permanently blocked.
+# Counters are per-process with the default in-memory storage. When running more
+# than one worker or replica, point RATE_LIMIT_STORAGE_URI at a shared backend
+# (e.g. "redis://redis:6379/0", needs the `redis` package) so limits are enforced
+# globally instead of N times over. RATE_LIMIT_STRATEGY accepts "fixed-window",
+# "moving-window" or "sliding-window-counter". With shared storage, counters are
+# kept across restarts, and resetting a single IP is only supported on Redis.
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+RATE_LIMIT_STRATEGY = os.getenv("RATE_LIMIT_STRATEGY", "fixed-window")
+
 limiter = Limiter(
     key_func=get_ip_key,
     default_limits=[],  # No global default - each endpoint must have explicit limits
-    storage_uri="memory://",  # In-memory storage (can be changed to Redis later)
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    strategy=RATE_LIMIT_STRATEGY,
 )
 
 
@@ -33,6 +44,10 @@ def rate_limit_per_ip(limit: str) -> Callable:
     return limiter.limit(limit, key_func=get_ip_key)
 
 
+def _uses_memory_storage() -> bool:
+    return RATE_LIMIT_STORAGE_URI.startswith("memory://")
+
+
 def _get_storage_dict(storage) -> dict | None:
     """Get the internal storage dictionary from slowapi's memory storage."""
     if hasattr(storage, "_storage") and isinstance(storage._storage, dict):
@@ -42,12 +57,39 @@ def _get_storage_dict(storage) -> dict | None:
     return None
 
 
+def _get_memory_dicts(storage, storage_dict: dict) -> list[dict]:
+    """
+    Every dict the memory storage keys by rate limit key: the counters, plus
+    the moving-window events and the expiry times kept next to them.
+    """
+    dicts = [storage_dict]
+    for name in ("events", "expirations"):
+        extra = getattr(storage, name, None)
+        if isinstance(extra, dict) and extra is not storage_dict:
+            dicts.append(extra)
+    return dicts
+
+
+def _clear_memory_dicts(storage, storage_dict: dict) -> int:
+    """Clear the memory storage, returning the number of rate limit keys it held."""
+    dicts = _get_memory_dicts(storage, storage_dict)
+    count = len(set().union(*dicts))
+    for entries in dicts:
+        entries.clear()
+    return count
+
+
 def reset_all_rate_limits() -> int:
     """
     Reset all rate limits by clearing the storage.
     This should be called on startup to ensure a clean state.
     Returns the number of entries cleared.
     """
+    if not _uses_memory_storage():
+        # Shared counters also belong to the other workers and replicas
+        logger.info("Rate limits are in shared storage, keeping them on startup")
+        return 0
+
     try:
         # Access the private _storage attribute
         storage = limiter._storage
@@ -76,9 +118,8 @@ def reset_all_rate_limits() -> int:
             logger.warning("Could not reset rate limits: storage dict not accessible and no reset method")
             return 0
         
-        count = len(storage_dict)
+        count = _clear_memory_dicts(storage, storage_dict)
         if count > 0:
-            storage_dict.clear()
             logger.info(f"Reset all rate limits on startup: cleared {count} entries")
         return count
     except Exception as e:
@@ -101,22 +142,16 @@ def reset_rate_limit_for_ip(ip: str) -> bool:
         storage_dict = _get_storage_dict(storage)
         
         if storage_dict is None:
-            # Try alternative methods
-            if hasattr(storage, "reset"):
-                try:
-                    storage.reset(ip)
-                    return True
-                except Exception:
-                    pass
-            return False
+            return _reset_shared_rate_limit_for_ip(storage, ip)
         
         cleared = False
         # slowapi stores entries with keys like "LIMITER:{ip}:{endpoint}"
         # We need to find all keys that contain this IP
         # Also handle cases where IP might be in different positions
         keys_to_remove = []
+        memory_dicts = _get_memory_dicts(storage, storage_dict)
         
-        for key in list(storage_dict.keys()):
+        for key in set().union(*memory_dicts):
             if isinstance(key, str):
                 # Check multiple patterns:
                 # - "LIMITER:{ip}:{endpoint}"
@@ -130,12 +165,10 @@ def reset_rate_limit_for_ip(ip: str) -> bool:
                     keys_to_remove.append(key)
         
         for key in keys_to_remove:
-            try:
-                del storage_dict[key]
-                cleared = True
-                logger.info(f"Cleared rate limit key: {key}")
-            except KeyError:
-                pass
+            for entries in memory_dicts:
+                entries.pop(key, None)
+            cleared = True
+            logger.info(f"Cleared rate limit key: {key}")
         
         if cleared:
             logger.info(f"Successfully cleared rate limits for IP: {ip}")
@@ -148,6 +181,24 @@ def reset_rate_limit_for_ip(ip: str) -> bool:
         return False
 
 
+def _reset_shared_rate_limit_for_ip(storage, ip: str) -> bool:
+    """Delete the counters of an IP from shared storage. Only Redis can be searched by key."""
+    client = getattr(storage, "storage", None)
+    if not hasattr(client, "scan_iter"):
+        logger.warning(f"Cannot reset rate limits for IP {ip}: {RATE_LIMIT_STORAGE_URI.split('://', 1)[0]} storage can't be searched by key")
+        return False
+
+    # limits stores counters under "LIMITS:LIMITER/{ip}/{endpoint}/..."
+    keys = list(client.scan_iter(match=storage.prefixed_key(f"LIMITER/{ip}/*")))
+    if not keys:
+        logger.warning(f"No rate limit entries found for IP: {ip}")
+        return False
+
+    client.delete(*keys)
+    logger.info(f"Successfully cleared {len(keys)} rate limit keys for IP: {ip}")
+    return True
+
+
 def clear_all_rate_limits() -> int:
     """
     Clear all rate limit entries. Use with caution - this affects all IPs.
@@ -159,10 +210,12 @@ def clear_all_rate_limits() -> int:
         storage_dict = _get_storage_dict(storage)
         
         if storage_dict is None:
-            return 0
+            # Shared backends delete their own keys and report how many
+            count = storage.reset() or 0
+            logger.warning(f"Cleared all {count} rate limit entries from {RATE_LIMIT_STORAGE_URI.split('://', 1)[0]} storage")
+            return count
         
-        count = len(storage_dict)
-        storage_dict.clear()
+        count = _clear_memory_dicts(storage, storage_dict)
         logger.warning(f"Cleared all {count} rate limit entries")
         return count
     except Exception as e:
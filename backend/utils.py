@@ -39,33 +39,45 @@ def get_password_hash(password: str) -> str:
 def get_client_ip(request: Request) -> Optional[str]:
     if not request:
         return None
+    return get_client_ip_from_scope(request.scope)
+
+
+def get_client_ip_from_scope(scope: dict) -> Optional[str]:
+    # Resolved once per request and shared through the request state, since
+    # the access log, the rate limiter and endpoints all ask for it
+    state = scope.setdefault("state", {})
+    if "client_ip" not in state:
+        state["client_ip"] = _resolve_client_ip(scope)
+    return state["client_ip"]
+
+
+def _resolve_client_ip(scope: dict) -> Optional[str]:
+    real_ip = None
+    forwarded = None
+    # ASGI header names are already lower-cased bytes
+    for key, value in scope.get("headers") or ():
+        if key == b"x-real-ip" and real_ip is None:
+            real_ip = value
+        elif key == b"x-forwarded-for" and forwarded is None:
+            forwarded = value
 
-    headers = request.headers
-    
     # First, check x-real-ip header (set by some proxies, or configured in Caddy)
-    real_ip = headers.get("x-real-ip") or headers.get("X-Real-IP")
     if real_ip:
-        candidate = real_ip.strip()
+        candidate = real_ip.decode("latin-1").strip()
         if candidate:
             return candidate
-    
+
     # Fall back to x-forwarded-for header (Caddy sets this automatically)
-    forwarded = headers.get("x-forwarded-for") or headers.get("X-Forwarded-For")
     if forwarded:
         # X-Forwarded-For can contain multiple IPs: "client, proxy1, proxy2"
         # Take the first one (original client IP)
-        candidate = forwarded.split(",")[0].strip()
+        candidate = forwarded.decode("latin-1").split(",")[0].strip()
         if candidate:
             return candidate
 
     # Fall back to direct client connection (when not behind a proxy)
-    if request.client and request.client.host:
-        return request.client.host
-
-    # Last resort: check scope
-    if isinstance(request.scope, dict):
-        client_info = request.scope.get("client")
-        if isinstance(client_info, (list, tuple)) and client_info:
-            return client_info[0]
+    client_info = scope.get("client")
+    if isinstance(client_info, (list, tuple)) and client_info and client_info[0]:
+        return client_info[0]
 
-    return None
\ No newline at end of file
+    return None
@@ -187,11 +187,8 @@ async def dmSend(manager: MessaggingSocketManager, websocket: WebSocket, db: Ses
     }
     
     # Send push notification for DM
-    try:
-        from push_service import push_service
-        await push_service.send_dm_notification(db, env, user)
-    except Exception as e:
-        logger.error(f"Failed to send push notification for DM {env.id}: {e}")
+    from push_service import push_service
+    push_service.schedule_dm_notification(env.id, user.id)
     
     await manager.send_update_to_user(env.recipient_id, "dmNew", payload_ws["data"], db)
     await manager.send_update_to_user(env.sender_id, "dmNew", payload_ws["data"], db)
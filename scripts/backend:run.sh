@@ -3,6 +3,8 @@ dotenv -e ../deployment/.env -- \
     ../.venv/bin/uvicorn main:app \
     --host 127.0.0.1 \
     --port 8300 \
+    --loop uvloop \
+    --http httptools \
     --reload \
     --reload-exclude './alembic' \
     --reload-exclude './alembic/*' \